@@ -1,32 +1,507 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from retriever import query_knowledge_graph
-from route import generate_response
-from typing import List
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from pydantic import BaseModel, Field
+from retriever import query_knowledge_graph, query_knowledge_graph_batch, registry, open_graph, embedding_cache, close_driver, inference, InferenceQueueFull, GraphTimeout, stage_timeout, EMBED_TIMEOUT, BATCH_CHUNK_SIZE, MODEL_EAGER_LOAD
+from route import generate_response, stream_response, fallback_response, LLM_TIMEOUT
+from metrics import request_id, accept_request_id, profiler, REQUESTS, STAGE_LATENCY, DEGRADED, MULTIPROCESS
+from openai import OpenAIError
+from contextlib import asynccontextmanager
+from prometheus_client import REGISTRY, CollectorRegistry, multiprocess, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from typing import List, Optional
+from collections import OrderedDict
 import asyncio
+import torch
+import json
+import time
+import os
 
 app = FastAPI()
 
+# Server-side caches for retrieval results and generated responses
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "600"))  # seconds an entry stays valid
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))  # entries per cache before the oldest are evicted
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0"))  # 0 disables near-duplicate symptom sets
+
+# Admission control, per worker: requests running the pipeline at once and how many may wait for a slot
+MAX_INFLIGHT = int(os.getenv("MAX_INFLIGHT", "32"))
+MAX_QUEUED = int(os.getenv("MAX_QUEUED", "64"))  # beyond this, requests get a 429 right away
+QUEUE_TIMEOUT = float(os.getenv("QUEUE_TIMEOUT", "2"))  # seconds a request waits for a slot before a 503
+
+
+class ResponseCache:
+    """
+    TTL and size-bounded LRU cache of coroutine results. Concurrent callers asking for the same key
+    share one in-flight computation (single-flight) instead of each running it.
+    """
+
+    def __init__(self, ttl:float=RESPONSE_CACHE_TTL, max_entries:int=RESPONSE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def get_or_compute(self, key, compute, cacheable=None):
+        """
+        cacheable, when given, decides from the computed value whether it may be stored
+        """
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        # Someone is already computing this key, wait for their result
+        if key in self.inflight:
+            self.shared += 1
+            return await asyncio.shield(self.inflight[key])
+
+        self.misses += 1
+        task = asyncio.ensure_future(compute())
+        self.inflight[key] = task
+
+        # The task outlives a cancelled caller, so it stores and unregisters itself
+        def finish(task):
+            self.inflight.pop(key, None)
+            if not task.cancelled() and task.exception() is None and (cacheable is None or cacheable(task.result())):
+                self.put(key, task.result())
+        task.add_done_callback(finish)
+
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "shared": self.shared, "entries": len(self.entries), "inflight": len(self.inflight)}
+
+
+retrieval_cache = ResponseCache()
+generation_cache = ResponseCache()
+
+
+class AdmissionControl:
+    """
+    Caps the requests running the pipeline at once. Up to max_queued more wait for a slot, anything
+    beyond that is turned away immediately rather than adding to everyone else's latency.
+    """
+
+    def __init__(self, max_inflight:int=MAX_INFLIGHT, max_queued:int=MAX_QUEUED, wait_timeout:float=QUEUE_TIMEOUT):
+        self.slots = asyncio.Semaphore(max_inflight)
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.wait_timeout = wait_timeout
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    @asynccontextmanager
+    async def admit(self):
+        if self.slots.locked() and self.waiting >= self.max_queued:
+            self.rejected += 1
+            raise HTTPException(status_code=429, detail="Too many requests, try again shortly.", headers={"Retry-After": "1"})
+
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), stage_timeout(self.wait_timeout))
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise HTTPException(status_code=503, detail="Server is busy, try again shortly.", headers={"Retry-After": "1"})
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self.slots.release()
+
+    def stats(self) -> dict:
+        return {"running": self.running, "waiting": self.waiting, "max_inflight": self.max_inflight, "max_queued": self.max_queued, "rejected": self.rejected, "timed_out": self.timed_out}
+
+
+admission = AdmissionControl()
+
+# Embeddings of the cached symptom sets, for near-duplicate lookups
+semantic_keys = OrderedDict()
+
+
+def distinct_symptoms(symptoms:list) -> dict:
+    """
+    Normalized form -> the caller's first spelling of every non-blank symptom.
+    Only the cache keys use the normalized form, retrieval gets the caller's spelling.
+    """
+    distinct = {}
+    for symptom in symptoms:
+        spelling = " ".join(symptom.split())
+        if spelling:
+            distinct.setdefault(spelling.lower(), spelling)
+    return distinct
+
+
+def symptoms_key(request, symptoms:dict) -> tuple:
+    # Order, case and repeats of the symptoms do not change the retrieval
+    relationship_types = tuple(sorted(request.relationship_types)) if request.relationship_types else None
+    return (tuple(sorted(symptoms)), request.per_symptom, request.per_result, relationship_types)
+
+
+async def similar_key(key:tuple):
+    """
+    Find a cached symptom set whose embedding is close enough to this one to reuse its results
+    """
+    try:
+        vector = (await asyncio.wait_for(inference.encode([", ".join(key[0])]), stage_timeout(EMBED_TIMEOUT)))[0]
+    except (asyncio.TimeoutError, InferenceQueueFull):
+        # Not worth waiting for, the exact lookup still runs
+        return None
+    vector = vector / vector.norm().clamp(min=1e-12)
+
+    best, best_score = None, SEMANTIC_CACHE_THRESHOLD
+    if semantic_keys:
+        keys = [other for other in semantic_keys if other[1:] == key[1:] and retrieval_cache.get(other) is not None]
+        if keys:
+            scores = torch.stack([semantic_keys[other] for other in keys]) @ vector
+            score, index = scores.max(dim=0)
+            if score.item() >= best_score:
+                best = keys[index.item()]
+
+    semantic_keys[key] = vector
+    while len(semantic_keys) > RESPONSE_CACHE_SIZE:
+        semantic_keys.popitem(last=False)
+
+    return best
+
+
+class PipelineCollector:
+    """
+    Exposes the counters the caches and the inference worker already keep, read at scrape time.
+    With several workers these only cover the worker answering the scrape, so they carry its pid.
+    """
+
+    def collect(self):
+        caches = {"embedding": embedding_cache.stats(), "retrieval": retrieval_cache.stats(), "generation": generation_cache.stats()}
+        worker = [str(os.getpid())] if MULTIPROCESS else []
+        labels = ["pid"] if MULTIPROCESS else []
+
+        hits = CounterMetricFamily("medicalrag_cache_hits", "Cache hits", labels=["cache"] + labels)
+        misses = CounterMetricFamily("medicalrag_cache_misses", "Cache misses", labels=["cache"] + labels)
+        entries = GaugeMetricFamily("medicalrag_cache_entries", "Entries held in memory", labels=["cache"] + labels)
+        for name, stats in caches.items():
+            hits.add_metric([name] + worker, stats["hits"])
+            misses.add_metric([name] + worker, stats["misses"])
+            entries.add_metric([name] + worker, stats["entries"])
+        yield hits
+        yield misses
+        yield entries
+
+        stats = inference.stats()
+        depth = GaugeMetricFamily("medicalrag_inference_queue_depth", "Encode jobs waiting for the inference worker", labels=labels)
+        batches = CounterMetricFamily("medicalrag_inference_batches", "Micro-batches run by the inference worker", labels=labels)
+        rejected = CounterMetricFamily("medicalrag_inference_rejected", "Encode jobs rejected because the queue was full", labels=labels)
+        abandoned = CounterMetricFamily("medicalrag_inference_abandoned", "Encode jobs skipped because their caller stopped waiting", labels=labels)
+        depth.add_metric(worker, stats["queue_depth"])
+        batches.add_metric(worker, stats["batches"])
+        rejected.add_metric(worker, stats["rejected"])
+        abandoned.add_metric(worker, stats["abandoned"])
+        yield depth
+        yield batches
+        yield rejected
+        yield abandoned
+
+
+REGISTRY.register(PipelineCollector())
+
 class QueryRequest(BaseModel):
     symptoms: List[str]
     user_input: str
+    per_symptom: int = Field(3, ge=1, le=100)  # candidates kept for each symptom
+    per_result: int = Field(5, ge=1, le=100)  # distinct results passed to the LLM
+    relationship_types: Optional[List[str]] = None  # only expand over these edge types, e.g. ["IS_A", "CAUSES"]
+
+class BatchQueryItem(BaseModel):
+    symptoms: List[str]
+    user_input: Optional[str] = None  # needed only when generating responses
+
+class BatchQueryRequest(BaseModel):
+    queries: List[BatchQueryItem]
+    per_symptom: int = Field(3, ge=1, le=100)
+    per_result: int = Field(5, ge=1, le=100)
+    relationship_types: Optional[List[str]] = None
+    generate: bool = False  # also run the LLM for every query
+    max_concurrency: int = Field(4, ge=1, le=32)  # LLM calls in flight at once
+
+@app.on_event("startup")
+async def load_model():
+    # Load in the background so the healthcheck can answer while the model warms up
+    if MODEL_EAGER_LOAD:
+        asyncio.get_running_loop().run_in_executor(None, registry.load)
+    inference.start()
+
+@app.on_event("startup")
+async def connect_graph():
+    # Neo4j driver or memory-mapped snapshot, then the embedding index checked against that graph build
+    await open_graph()
+
+@app.on_event("shutdown")
+async def disconnect_graph():
+    await close_driver()
+
+@app.middleware("http")
+async def instrument(request: Request, call_next):
+    # Reuse the caller's request id so the UI, API and LLM logs can be joined
+    current = accept_request_id(request.headers.get("X-Request-ID"))
+    token = request_id.set(current)
+
+    # Symptom extraction runs in the UI, which reports how long it took
+    extraction_ms = request.headers.get("X-Extraction-Ms")
+    if extraction_ms:
+        try:
+            STAGE_LATENCY.labels("extraction").observe(float(extraction_ms) / 1000)
+        except ValueError:
+            pass
+
+    profile = profiler.start() if profiler.enabled else None
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_LATENCY.labels("request").observe(elapsed)
+        # Label by route template, unknown paths would grow the label set without bound
+        route = request.scope.get("route")
+        REQUESTS.labels(route.path if route else "unmatched", str(status)).inc()
+        if profile is not None:
+            profiler.stop(profile, elapsed * 1000, current)
+        request_id.reset(token)
+
+    response.headers["X-Request-ID"] = current
+    return response
+
+@app.get("/metrics")
+def metrics():
+    if not MULTIPROCESS:
+        return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+    # Every worker writes its samples to PROMETHEUS_MULTIPROC_DIR, merge them for this scrape
+    collectors = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collectors)
+    collectors.register(PipelineCollector())
+    return Response(generate_latest(collectors), media_type=CONTENT_TYPE_LATEST)
 
 @app.get("/healthcheck")
-def healthcheck():
-    return {"status": "API is running"}
+def healthcheck(response: Response):
+    if registry.ready:
+        return {
+            "status": "API is running",
+            "embedding_cache": embedding_cache.stats(),
+            "inference": inference.stats(),
+            "retrieval_cache": retrieval_cache.stats(),
+            "generation_cache": generation_cache.stats(),
+            "admission": admission.stats(),
+        }
 
-@app.post("/query")
-async def handle_query(request: QueryRequest):
-    symptoms = request.symptoms
-    user_input = request.user_input
-    
-    # Get answers asynchronously first, then use them for response generation
-    answers = await query_knowledge_graph(symptoms)
+    # In lazy mode the model is only loaded by the first query
+    if not MODEL_EAGER_LOAD:
+        return {"status": "API is running", "model": "not loaded"}
+
+    response.status_code = 503
+    return {"status": "not ready"}
+
+def record_degraded(degraded:list):
+    for path in degraded:
+        DEGRADED.labels(path).inc()
+
+async def retrieve(request: QueryRequest):
+    """
+    Ranked answers and the degraded paths retrieval took, e.g. ["embedding_timeout"]
+    """
+    symptoms = distinct_symptoms(request.symptoms)
+    if not symptoms:
+        raise HTTPException(status_code=404, detail="No relevant diseases found.")
+    key = symptoms_key(request, symptoms)
+
+    async def compute():
+        degraded = []
+        answers = await query_knowledge_graph([symptoms[symptom] for symptom in sorted(symptoms)], request.per_symptom, request.per_result, request.relationship_types, degraded)
+        return answers, degraded
+
+    # Get answers asynchronously first, then use them for response generation.
+    # Degraded rankings are not cached, the next request gets a chance at the full one
+    try:
+        if SEMANTIC_CACHE_THRESHOLD > 0 and retrieval_cache.get(key) is None:
+            key = await similar_key(key) or key
+        answers, degraded = await retrieval_cache.get_or_compute(key, compute, cacheable=lambda result: not result[1])
+    except GraphTimeout:
+        raise HTTPException(status_code=504, detail="The knowledge graph did not answer in time.")
     
     if not answers:
         raise HTTPException(status_code=404, detail="No relevant diseases found.")
+
+    return answers, list(degraded)
+
+async def generate(user_input, answers) -> tuple[str, list]:
+    """
+    The generated response, or the raw findings when the LLM misses LLM_TIMEOUT or fails
+    """
+    key = (" ".join(user_input.split()), tuple(answers))
+    try:
+        # A timed out generation keeps running in the cache and is stored when it completes
+        response = await asyncio.wait_for(generation_cache.get_or_compute(key, lambda: generate_response(user_input, answers)), stage_timeout(LLM_TIMEOUT))
+        return response, []
+    except asyncio.TimeoutError:
+        return fallback_response(answers), ["llm_timeout"]
+    except OpenAIError:
+        return fallback_response(answers), ["llm_unavailable"]
+
+@app.post("/query")
+async def handle_query(request: QueryRequest):
+    async with admission.admit():
+        answers, degraded = await retrieve(request)
+
+        # Now generate the response using the obtained answers
+        response, fallbacks = await generate(request.user_input, answers)
     
-    # Now generate the response using the obtained answers
-    response = await generate_response(user_input, answers)
-    
-    return {"response": response}
\ No newline at end of file
+    degraded += fallbacks
+    record_degraded(degraded)
+    return {"response": response, "degraded": degraded}
+
+@app.post("/query/stream")
+async def handle_query_stream(request: QueryRequest):
+    # Retrieval errors and the wait for the first token happen before the stream starts, so they keep
+    # their status code. The slot is held until then, the rest of the stream only waits on the LLM
+    async with admission.admit():
+        answers, degraded = await retrieve(request)
+
+        chunks = cached_stream(request.user_input, answers)
+        try:
+            first = await asyncio.wait_for(chunks.__anext__(), stage_timeout(LLM_TIMEOUT))
+        except StopAsyncIteration:
+            first = ""
+        except (asyncio.TimeoutError, OpenAIError) as error:
+            await chunks.aclose()
+            degraded.append("llm_timeout" if isinstance(error, asyncio.TimeoutError) else "llm_unavailable")
+            record_degraded(degraded)
+            return PlainTextResponse(fallback_response(answers), headers={"X-Degraded": ",".join(degraded)})
+
+    async def rest():
+        yield first
+        async for chunk in chunks:
+            yield chunk
+
+    # Tokens are sent as plain text chunks as soon as the model produces them
+    record_degraded(degraded)
+    headers = {"X-Degraded": ",".join(degraded)} if degraded else None
+    return StreamingResponse(rest(), media_type="text/plain; charset=utf-8", headers=headers)
+
+async def cached_stream(user_input, answers):
+    # A cached response is sent in one chunk, a fresh one is streamed and cached once complete
+    key = (" ".join(user_input.split()), tuple(answers))
+    cached = generation_cache.get(key)
+    if cached is not None:
+        generation_cache.hits += 1
+        yield cached
+        return
+
+    generation_cache.misses += 1
+    chunks = []
+    async for chunk in stream_response(user_input, answers):
+        chunks.append(chunk)
+        yield chunk
+    generation_cache.put(key, "".join(chunks).strip())
+
+async def rank_chunk(request: BatchQueryRequest, queries:list, start:int) -> list:
+    """
+    (position, results, degraded) of the BATCH_CHUNK_SIZE queries from start, ranked under one admission slot
+    """
+    async with admission.admit():
+        chunk = queries[start:start + BATCH_CHUNK_SIZE]
+        return [(start + offset, answers, degraded) async for offset, answers, degraded in query_knowledge_graph_batch(chunk, request.per_symptom, request.per_result, request.relationship_types)]
+
+@app.post("/query/batch")
+async def handle_query_batch(request: BatchQueryRequest):
+    queries = [[spelling for _, spelling in sorted(distinct_symptoms(item.symptoms).items())] for item in request.queries]
+
+    # Every chunk takes an admission slot like a /query request. The first one is ranked before the
+    # stream starts, so a saturated server or a graph timeout still answer with their status code
+    try:
+        first = await rank_chunk(request, queries, 0)
+    except GraphTimeout:
+        raise HTTPException(status_code=504, detail="The knowledge graph did not answer in time.")
+
+    # One JSON line per query, in the order they finish
+    return StreamingResponse(batch_lines(request, queries, first), media_type="application/x-ndjson")
+
+async def batch_lines(request: BatchQueryRequest, queries:list, first:list):
+    slots = asyncio.Semaphore(request.max_concurrency)
+    pending = set()
+
+    def result_line(position, answers, degraded):
+        line = {"index": position, "symptoms": queries[position], "results": answers}
+        if degraded:
+            line["degraded"] = degraded
+        return line
+
+    async def generate_line(position, answers, degraded):
+        line = result_line(position, answers, degraded)
+        try:
+            async with slots:
+                line["response"], fallbacks = await generate(request.queries[position].user_input, answers)
+            if fallbacks:
+                line["degraded"] = degraded + fallbacks
+        except Exception as error:
+            line["error"] = str(error)
+        record_degraded(line.get("degraded", []))
+        return json.dumps(line) + "\n"
+
+    async def finished(wait_all=False):
+        # Lines of the generations that are done, waiting for at least one when too many are in flight
+        nonlocal pending
+        if not pending:
+            return []
+        if wait_all or len(pending) >= 2 * request.max_concurrency:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.ALL_COMPLETED if wait_all else asyncio.FIRST_COMPLETED)
+        else:
+            done = {task for task in pending if task.done()}
+            pending -= done
+        return [task.result() for task in done]
+
+    try:
+        for start in range(0, len(queries), BATCH_CHUNK_SIZE):
+            ranked = first if start == 0 else await rank_chunk(request, queries, start)
+            for position, answers, degraded in ranked:
+                if request.generate and answers and request.queries[position].user_input:
+                    pending.add(asyncio.ensure_future(generate_line(position, answers, degraded)))
+                else:
+                    record_degraded(degraded)
+                    yield json.dumps(result_line(position, answers, degraded)) + "\n"
+
+                for line in await finished():
+                    yield line
+    except GraphTimeout:
+        yield json.dumps({"error": "The knowledge graph did not answer in time, the rest of the batch was not processed."}) + "\n"
+    except HTTPException as error:
+        # Admission refused a later chunk, the status code was already sent
+        yield json.dumps({"error": f"{error.detail} The rest of the batch was not processed."}) + "\n"
+
+    for line in await finished(wait_all=True):
+        yield line
@@ -0,0 +1,83 @@
+"""
+Compare the local dictionary extractor with the GPT extractor on a fixed query set.
+
+Run from the repository root after building the matcher (python extractor.py):
+    python benchmarks/extractors.py [--no-gpt]
+"""
+from pathlib import Path
+from openai import OpenAI
+import statistics
+import json
+import sys
+import time
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from extractor import SymptomMatcher
+
+# Queries with the terms a correct extractor must return
+QUERIES = [
+    ("what is hemoglobin", ["hemoglobin"]),
+    ("he has diabetes and hypertension", ["diabetes", "hypertension"]),
+    ("I have had a fever and a headache since yesterday", ["fever", "headache"]),
+    ("my child has a cough and a runny nose", ["cough", "runny nose"]),
+    ("sharp chest pain when breathing in", ["chest pain"]),
+    ("is asthma related to eczema", ["asthma", "eczema"]),
+    ("I feel nausea and dizziness after taking ibuprofen", ["nausea", "dizziness", "ibuprofen"]),
+    ("what causes migraine", ["migraine"]),
+    ("swollen ankles and shortness of breath", ["swollen ankles", "shortness of breath"]),
+    ("my mother was diagnosed with type 2 diabetes mellitus", ["type 2 diabetes mellitus"]),
+    ("can anemia cause fatigue", ["anemia", "fatigue"]),
+    ("rash on my arm after a tick bite", ["rash", "tick bite"]),
+]
+
+
+def gpt_extractor():
+    """
+    The GPT path of main.py, without the Streamlit UI around it
+    """
+    import streamlit as st
+    client = OpenAI(api_key=st.secrets["openai"]["api_key"])
+
+    def extract(user_input):
+        prompt = (
+            "The following user input contains medical terminology. Identify all medical terms mentioned. "
+            "Provide a comma-separated list of the terms exactly as they appear in the input.\n"
+            f"Here is the user input: \"{user_input}\""
+        )
+        response = client.chat.completions.create(model="gpt-3.5-turbo", messages=[{"role": "user", "content": prompt}])
+        return [term.strip().lower() for term in response.choices[0].message.content.split(",")]
+
+    return extract
+
+
+def evaluate(extract) -> dict:
+    """
+    Recall of the expected terms and per-query latency of one extractor
+    """
+    latencies, found, expected = [], 0, 0
+    for query, terms in QUERIES:
+        start = time.perf_counter()
+        extracted = extract(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        # A term counts as recalled when an extracted term contains it or is contained by it
+        found += sum(any(term in other or other in term for other in extracted) for term in terms)
+        expected += len(terms)
+
+    latencies.sort()
+    return {
+        "recall": round(found / expected, 3),
+        "p50_ms": round(statistics.median(latencies), 4),
+        "p95_ms": round(latencies[int(0.95 * (len(latencies) - 1))], 4),
+    }
+
+
+def main():
+    results = {"local": evaluate(SymptomMatcher.load().extract)}
+    if "--no-gpt" not in sys.argv:
+        results["gpt"] = evaluate(gpt_extractor())
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
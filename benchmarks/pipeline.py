@@ -0,0 +1,485 @@
+"""
+Load benchmark of query_knowledge_graph and the /query routes against local stand-ins: a generated
+graph snapshot, a randomly initialized BERT and a stub OpenAI-compatible server. Nothing needs Neo4j,
+an OpenAI key or a model download, and the same --seed always generates the same fixture and queries.
+
+    python benchmarks/pipeline.py [--nodes 50000] [--concurrency 1,8,32] [--requests 200] [--baseline old.json]
+
+Every scenario reports p50/p95/p99 latency, throughput and peak RSS, plus the per-stage breakdown
+from the pipeline's own histograms, and the run is saved as JSON next to the commit it measured.
+"""
+from pathlib import Path
+from multiprocessing import Process
+import numpy as np
+import subprocess
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import asyncio
+import random
+import socket
+import json
+import math
+import sys
+import os
+import time
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT))
+sys.path.append(str(ROOT / "graphConstruction"))
+
+# Pseudo-words for the fixture's concept terms, the tiny model's vocabulary is built from the same words
+SYLLABLES = ["ba", "ce", "di", "fo", "gu", "ha", "ke", "li", "mo", "nu", "pa", "re", "si", "to", "vu", "xa", "ze", "lo", "mi", "ro"]
+TAGS = ["disorder", "finding", "procedure", "substance", "organism"]
+RELATIONSHIP_TYPES = ["IS_A", "FINDING_SITE", "ASSOCIATED_MORPHOLOGY", "CAUSATIVE_AGENT", "DUE_TO", "HAS_ACTIVE_INGREDIENT"]
+
+SCENARIOS = ["retrieval", "query", "stream"]
+
+
+def build_fixture(path, nodes:int, degree:int, seed:int):
+    """
+    Random concept graph with SNOMED-shaped descriptions, written in the graph snapshot format.
+    Returns the plain term of every concept, each one seeds a lookup, and the words they use.
+    """
+    from graph_snapshot import write_snapshot, token_hashes
+
+    rng = random.Random(seed)
+    words = sorted({"".join(rng.choices(SYLLABLES, k=rng.randint(2, 4))) for _ in range(max(1000, nodes // 5))})
+
+    ids = rng.sample(range(10**8, 10**9), nodes)
+    text_offsets, text, hashes, hash_rows, terms = [0], bytearray(), [], [], []
+    for row in range(nodes):
+        synonyms = [" ".join(rng.choices(words, k=rng.randint(1, 3))) for _ in range(rng.randint(1, 3))]
+        terms.append(synonyms[0])
+        synonyms[0] = f"{synonyms[0]} ({rng.choice(TAGS)})"
+
+        descriptions = ";".join(synonyms)
+        text.extend(descriptions.encode("utf-8"))
+        text_offsets.append(len(text))
+        for key in token_hashes(descriptions):
+            hashes.append(key)
+            hash_rows.append(row)
+
+    # Edges between random concepts, never a self loop
+    generator = np.random.default_rng(seed)
+    sources = generator.integers(0, nodes, nodes * degree)
+    destinations = (sources + generator.integers(1, nodes, nodes * degree)) % nodes
+    type_names = [RELATIONSHIP_TYPES[code] for code in generator.integers(0, len(RELATIONSHIP_TYPES), nodes * degree)]
+
+    write_snapshot(path, f"fixture-{nodes}-{degree}-{seed}", ids, text_offsets, text, hashes, hash_rows, sources, destinations, type_names)
+    return terms, words
+
+
+def build_model(path, words:list, hidden:int, layers:int, seed:int):
+    """
+    Randomly initialized BERT with a word-level vocabulary over the fixture, saved like a hub checkpoint
+    """
+    from transformers import BertConfig, BertModel, BertTokenizerFast
+    import torch
+
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "(", ")", ";", ","] + TAGS + words
+    with open(path / "vocab.txt", "w") as file:
+        file.write("\n".join(vocab) + "\n")
+    BertTokenizerFast(vocab_file=str(path / "vocab.txt"), do_lower_case=True).save_pretrained(path)
+
+    torch.manual_seed(seed)
+    config = BertConfig(vocab_size=len(vocab), hidden_size=hidden, num_hidden_layers=layers, num_attention_heads=max(1, hidden // 64), intermediate_size=4 * hidden)
+    BertModel(config).save_pretrained(path)
+
+
+def serve_stub_llm(port:int, latency_ms:float, token_ms:float, tokens:int):
+    """
+    OpenAI-compatible chat completions endpoint that answers after a fixed delay, run in its own process
+    """
+    from fastapi import FastAPI, Request
+    from fastapi.responses import StreamingResponse
+    import uvicorn
+
+    app = FastAPI()
+    pieces = [f"token{index} " for index in range(tokens)]
+
+    @app.post("/v1/chat/completions")
+    async def completions(request: Request):
+        body = await request.json()
+        created = int(time.time())
+        await asyncio.sleep(latency_ms / 1000)
+
+        if not body.get("stream"):
+            # The whole answer takes as long as the streamed one would
+            await asyncio.sleep(tokens * token_ms / 1000)
+            return {
+                "id": "stub", "object": "chat.completion", "created": created, "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(pieces)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": tokens, "total_tokens": tokens},
+            }
+
+        async def chunks():
+            for piece in pieces:
+                chunk = {"id": "stub", "object": "chat.completion.chunk", "created": created, "model": body["model"], "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep(token_ms / 1000)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(chunks(), media_type="text/event-stream")
+
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port:int, timeout:float=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"Nothing listening on port {port} after {timeout} seconds")
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        # No procfs, fall back to the lifetime peak
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class PeakRSS:
+    """
+    Samples the resident set size of this process in the background and keeps the peak since the last reset
+    """
+
+    def __init__(self, interval_ms:float=10):
+        self.interval = interval_ms / 1000
+        self.peak = rss_mb()
+        self._thread = threading.Thread(target=self._run, name="rss", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self.peak = max(self.peak, rss_mb())
+            time.sleep(self.interval)
+
+    def reset(self) -> float:
+        peak, self.peak = max(self.peak, rss_mb()), rss_mb()
+        return round(peak, 1)
+
+
+def stage_samples() -> dict:
+    """
+    Cumulative bucket counts, sum and count of every stage in the pipeline's latency histogram
+    """
+    from metrics import STAGE_LATENCY
+
+    stages = {}
+    for metric in STAGE_LATENCY.collect():
+        for sample in metric.samples:
+            stage = stages.setdefault(sample.labels["stage"], {"buckets": {}, "sum": 0.0, "count": 0})
+            if sample.name.endswith("_bucket"):
+                stage["buckets"][float(sample.labels["le"])] = sample.value
+            elif sample.name.endswith("_sum"):
+                stage["sum"] = sample.value
+            elif sample.name.endswith("_count"):
+                stage["count"] = sample.value
+    return stages
+
+
+def bucket_quantile(buckets:list, count:float, q:float) -> float:
+    """
+    Quantile of a histogram, interpolated linearly inside the bucket that holds it
+    """
+    rank = q * count
+    lower, previous = 0.0, 0.0
+    for bound, cumulative in buckets:
+        if cumulative >= rank:
+            if math.isinf(bound):
+                return lower
+            inside = cumulative - previous
+            return lower + (bound - lower) * ((rank - previous) / inside if inside else 0)
+        lower, previous = bound, cumulative
+    return lower
+
+
+def stage_report(before:dict, after:dict) -> dict:
+    report = {}
+    for name, stage in after.items():
+        earlier = before.get(name, {"buckets": {}, "sum": 0.0, "count": 0})
+        count = stage["count"] - earlier["count"]
+        if count <= 0:
+            continue
+        buckets = [(bound, value - earlier["buckets"].get(bound, 0)) for bound, value in sorted(stage["buckets"].items())]
+        report[name] = {
+            "count": int(count),
+            "mean_ms": round((stage["sum"] - earlier["sum"]) / count * 1000, 2),
+            **{f"p{int(q * 100)}_ms": round(bucket_quantile(buckets, count, q) * 1000, 2) for q in (0.5, 0.95, 0.99)},
+        }
+    return report
+
+
+def percentiles(values:list) -> dict:
+    if not values:
+        return {}
+    values = np.array(values) * 1000
+    return {
+        "p50": round(float(np.percentile(values, 50)), 2),
+        "p95": round(float(np.percentile(values, 95)), 2),
+        "p99": round(float(np.percentile(values, 99)), 2),
+        "mean": round(float(values.mean()), 2),
+        "max": round(float(values.max()), 2),
+    }
+
+
+def make_queries(rng:random.Random, terms:list, count:int, max_symptoms:int) -> list:
+    queries = []
+    for _ in range(count):
+        symptoms = rng.sample(terms, rng.randint(1, max_symptoms))
+        queries.append((symptoms, f"I have {', '.join(symptoms)}, what could it be?"))
+    return queries
+
+
+async def drive(call, queries:list, concurrency:int, sampler:PeakRSS) -> dict:
+    """
+    Closed loop: every worker sends its next query as soon as the previous one returned
+    """
+    latencies, first_bytes, errors = [], [], []
+    pending = iter(queries)
+
+    async def worker():
+        for query in pending:
+            start = time.perf_counter()
+            try:
+                first_byte = await call(query)
+            except Exception as error:
+                errors.append(repr(error))
+                continue
+            latencies.append(time.perf_counter() - start)
+            if first_byte is not None:
+                first_bytes.append(first_byte - start)
+
+    before = stage_samples()
+    sampler.reset()
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - start
+
+    result = {
+        "requests": len(queries),
+        "errors": len(errors),
+        "throughput_rps": round(len(latencies) / wall, 2),
+        "latency_ms": percentiles(latencies),
+        "peak_rss_mb": sampler.reset(),
+        "stages": stage_report(before, stage_samples()),
+    }
+    if first_bytes:
+        result["first_byte_ms"] = percentiles(first_bytes)
+    if errors:
+        result["first_error"] = errors[0]
+    return result
+
+
+async def run(args, terms:list, api_port:int) -> dict:
+    # Imported only now, the environment has to point at the stand-ins before these modules load
+    from retriever import query_knowledge_graph, registry
+    from api import app
+    import uvicorn
+    import httpx
+
+    sampler = PeakRSS()
+    sampler.start()
+    rng = random.Random(args.seed)
+    results = {}
+
+    # Startup loads the graph snapshot, then the model in the background
+    start = time.perf_counter()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=api_port, log_level="warning"))
+    serving = asyncio.ensure_future(server.serve())
+    while not (server.started and registry.ready):
+        if serving.done():
+            serving.result()
+            raise RuntimeError("API server stopped during startup")
+        if time.perf_counter() - start > args.startup_timeout:
+            raise TimeoutError(f"Model not loaded after {args.startup_timeout} seconds")
+        await asyncio.sleep(0.05)
+    results["startup"] = {"seconds": round(time.perf_counter() - start, 2), "peak_rss_mb": sampler.reset()}
+
+    client = httpx.AsyncClient(base_url=f"http://127.0.0.1:{api_port}", timeout=args.request_timeout, limits=httpx.Limits(max_connections=max(args.concurrency)))
+
+    async def retrieval(query):
+        await query_knowledge_graph(query[0])
+
+    async def post(query):
+        response = await client.post("/query", json={"symptoms": query[0], "user_input": query[1]})
+        response.raise_for_status()
+
+    async def stream(query):
+        first_byte = None
+        async with client.stream("POST", "/query/stream", json={"symptoms": query[0], "user_input": query[1]}) as response:
+            response.raise_for_status()
+            async for _ in response.aiter_raw():
+                if first_byte is None:
+                    first_byte = time.perf_counter()
+        return first_byte
+
+    calls = {"retrieval": retrieval, "query": post, "stream": stream}
+
+    try:
+        # Warm the kernels and the connection pool, not reported
+        for scenario in args.scenarios:
+            await drive(calls[scenario], make_queries(rng, terms, args.warmup, args.symptoms), 1, sampler)
+
+        runs = []
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                # Fresh queries for every run, so later runs are not just embedding cache hits
+                queries = make_queries(rng, terms, args.requests, args.symptoms)
+                result = await drive(calls[scenario], queries, concurrency, sampler)
+                runs.append({"scenario": scenario, "concurrency": concurrency, **result})
+                print(f"{scenario} x{concurrency}: p50 {result['latency_ms'].get('p50')} ms, p95 {result['latency_ms'].get('p95')} ms, {result['throughput_rps']} req/s, {result['errors']} errors")
+        results["runs"] = runs
+    finally:
+        await client.aclose()
+        server.should_exit = True
+        await serving
+
+    return results
+
+
+def environment(args) -> dict:
+    import torch
+
+    def git(*command):
+        try:
+            return subprocess.run(["git", *command], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    return {
+        "commit": git("rev-parse", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+    }
+
+
+def compare(baseline:dict, report:dict):
+    """
+    Print the change of p95 latency and throughput of every run that is also in the baseline
+    """
+    previous = {(run["scenario"], run["concurrency"]): run for run in baseline.get("runs", [])}
+    print(f"Compared with {baseline['environment'].get('commit')}:")
+    for run in report["runs"]:
+        old = previous.get((run["scenario"], run["concurrency"]))
+        if old is None or not old["latency_ms"] or not run["latency_ms"]:
+            continue
+        p95 = run["latency_ms"]["p95"] / old["latency_ms"]["p95"] - 1
+        throughput = run["throughput_rps"] / old["throughput_rps"] - 1 if old["throughput_rps"] else 0
+        print(f"  {run['scenario']} x{run['concurrency']}: p95 {old['latency_ms']['p95']} -> {run['latency_ms']['p95']} ms ({p95:+.1%}), throughput {old['throughput_rps']} -> {run['throughput_rps']} req/s ({throughput:+.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=50000, help="concepts in the generated graph")
+    parser.add_argument("--degree", type=int, default=4, help="edges per concept")
+    parser.add_argument("--hidden", type=int, default=128, help="hidden size of the random BERT")
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--llm-latency-ms", type=float, default=200, help="stub LLM delay before the first token")
+    parser.add_argument("--llm-token-ms", type=float, default=5, help="stub LLM delay between tokens")
+    parser.add_argument("--llm-tokens", type=int, default=50)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"comma-separated subset of {SCENARIOS}")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario and concurrency level")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--symptoms", type=int, default=3, help="most symptoms per request")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--request-timeout", type=float, default=60)
+    parser.add_argument("--startup-timeout", type=float, default=300)
+    parser.add_argument("--output", help="JSON report, benchmark-<commit>.json by default")
+    parser.add_argument("--baseline", help="earlier JSON report to compare with")
+    args = parser.parse_args()
+
+    args.scenarios = [name for name in args.scenarios.split(",") if name]
+    args.concurrency = [int(level) for level in args.concurrency.split(",")]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios {sorted(unknown)}")
+    if args.nodes < 2:
+        parser.error("--nodes must be at least 2")
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    output = Path(args.output).resolve() if args.output else None
+
+    with tempfile.TemporaryDirectory(prefix="medicalrag-bench-") as workdir:
+        workdir = Path(workdir)
+        llm_port, api_port = free_port(), free_port()
+
+        # The repository reads its credentials through st.secrets, so the run gets its own dummy ones
+        (workdir / ".streamlit").mkdir()
+        with open(workdir / ".streamlit" / "secrets.toml", "w") as file:
+            file.write('[neo4j]\nuri = "bolt://127.0.0.1:7687"\nuser = "bench"\npassword = "bench"\n\n[openai]\napi_key = "stub"\n')
+        os.chdir(workdir)
+
+        # Stand-ins for every external service, the tuning knobs keep any value already set
+        os.environ.update({
+            "GRAPH_BACKEND": "snapshot",
+            "GRAPH_SNAPSHOT_DIR": str(workdir / "graph_snapshot"),
+            "MODEL_NAME": str(workdir / "model"),
+            "MODEL_OFFLINE": "1",
+            "MODEL_EAGER_LOAD": "1",
+            "EMBED_INDEX_DIR": str(workdir / "embedding_index"),
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{llm_port}/v1",
+        })
+        os.environ.setdefault("EMBED_CACHE_PATH", "")
+        os.environ.setdefault("RESPONSE_CACHE_TTL", "0")
+
+        # Started before torch is imported, so the forked server stays small
+        stub = Process(target=serve_stub_llm, args=(llm_port, args.llm_latency_ms, args.llm_token_ms, args.llm_tokens), daemon=True)
+        stub.start()
+
+        try:
+            start = time.perf_counter()
+            terms, words = build_fixture(workdir / "graph_snapshot", args.nodes, args.degree, args.seed)
+            build_model(workdir / "model", words, args.hidden, args.layers, args.seed)
+            with open(workdir / "graph_snapshot" / "meta.json") as file:
+                fixture = {**json.load(file), "seconds": round(time.perf_counter() - start, 2)}
+            print(f"Fixture with {fixture['nodes']} nodes and {fixture['edges']} edges built in {fixture['seconds']} s.")
+
+            wait_for_port(llm_port)
+            report = {"environment": environment(args), "fixture": fixture}
+            report.update(asyncio.run(run(args, terms, api_port)))
+        finally:
+            stub.terminate()
+            stub.join()
+            os.chdir(ROOT)
+
+    output = output or ROOT / f"benchmark-{(report['environment']['commit'] or 'unknown')[:12]}.json"
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Report written to {output}.")
+
+    if baseline:
+        compare(baseline, report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Accuracy gate for reduced-precision inference: compares a MODEL_PRECISION / MODEL_TRACE mode with
+the fp32 baseline on a fixed symptom set and exits non-zero if the mode drifts too far.
+Tracing is not part of the embedding index's meta, `--precision fp32 --trace` is the check that it leaves the vectors unchanged.
+
+    python benchmarks/precision_gate.py --precision int8 [--trace] [--candidates CSVItem/merged_nodes.csv]
+"""
+from pathlib import Path
+import pandas as pd
+import argparse
+import json
+import sys
+import time
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from retriever import load_model, encode_batch, cosine_scores
+
+SYMPTOMS = [
+    "fever", "headache", "diabetes", "chest pain", "cough", "hypertension", "nausea", "rash", "fatigue", "asthma",
+    "shortness of breath", "abdominal pain", "dizziness", "anemia", "migraine", "back pain", "sore throat", "insomnia",
+]
+
+# Used when no candidate file is given, a spread of clinical terms to rank against the symptoms
+CANDIDATES = [
+    "Pyrexia", "Hyperthermia", "Tension-type headache", "Cluster headache", "Type 2 diabetes mellitus", "Type 1 diabetes mellitus",
+    "Angina pectoris", "Myocardial infarction", "Acute bronchitis", "Pneumonia", "Essential hypertension", "Hypotension",
+    "Vomiting", "Gastroenteritis", "Urticaria", "Eczema", "Chronic fatigue syndrome", "Hypothyroidism", "Status asthmaticus",
+    "Chronic obstructive lung disease", "Dyspnea", "Appendicitis", "Irritable bowel syndrome", "Vertigo", "Iron deficiency anemia",
+    "Migraine with aura", "Lumbago", "Sciatica", "Pharyngitis", "Tonsillitis", "Sleep apnea", "Depressive disorder",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--precision", default="int8", choices=["fp32", "int8", "bf16"])
+    parser.add_argument("--trace", action="store_true")
+    parser.add_argument("--candidates", help="merged_nodes.csv to sample candidate descriptions from")
+    parser.add_argument("--sample", type=int, default=2000)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--min-overlap", type=float, default=0.9, help="mean top-k overlap with fp32 required to pass")
+    parser.add_argument("--max-drift", type=float, default=0.02, help="mean 1 - cosine(fp32, mode) allowed")
+    args = parser.parse_args()
+
+    candidates = CANDIDATES
+    if args.candidates:
+        candidates = pd.read_csv(args.candidates, usecols=["descriptions"], dtype=str, nrows=args.sample)["descriptions"].dropna().tolist()
+    texts = SYMPTOMS + candidates
+
+    results = {}
+    for name, precision, trace in [("fp32", "fp32", False), ("mode", args.precision, args.trace)]:
+        tokenizer, model = load_model(precision, trace)
+        encode_batch(tokenizer, model, texts[:8])
+        start = time.perf_counter()
+        results[name] = encode_batch(tokenizer, model, texts)
+        results[f"{name}_seconds"] = time.perf_counter() - start
+
+    baseline, mode = results["fp32"], results["mode"]
+
+    # How far each vector moved, and whether the rankings built on them still agree
+    drift = 1 - cosine_scores(baseline, mode).diagonal()
+    k = min(args.top_k, len(candidates))
+    baseline_top = cosine_scores(baseline[:len(SYMPTOMS)], baseline[len(SYMPTOMS):]).topk(k, dim=1).indices
+    mode_top = cosine_scores(mode[:len(SYMPTOMS)], mode[len(SYMPTOMS):]).topk(k, dim=1).indices
+    overlap = [len(set(a.tolist()) & set(b.tolist())) / k for a, b in zip(baseline_top, mode_top)]
+
+    report = {
+        "precision": args.precision,
+        "trace": args.trace,
+        "mean_cosine_drift": round(drift.mean().item(), 5),
+        "max_cosine_drift": round(drift.max().item(), 5),
+        "mean_top_k_overlap": round(sum(overlap) / len(overlap), 3),
+        "min_top_k_overlap": round(min(overlap), 3),
+        "speedup": round(results["fp32_seconds"] / results["mode_seconds"], 2),
+    }
+    report["passed"] = report["mean_top_k_overlap"] >= args.min_overlap and report["mean_cosine_drift"] <= args.max_drift
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report["passed"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Compare embedding whole ';'-joined descriptions with embedding every synonym on its own.
+
+Reports encoder throughput and tokens processed for both modes, and how much the per-symptom
+top-k rankings agree, on a sample of concepts from merged_nodes.csv:
+    python benchmarks/term_pooling.py CSVItem/merged_nodes.csv [sample size]
+"""
+from pathlib import Path
+import pandas as pd
+import torch
+import json
+import sys
+import time
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import retriever
+from retriever import registry, encode_batch, cosine_scores, pool_scores
+
+SYMPTOMS = ["fever", "headache", "diabetes", "chest pain", "cough", "hypertension", "nausea", "rash", "fatigue", "asthma"]
+TOP_K = 10
+
+
+def score(tokenizer, model, descriptions, pooling):
+    """
+    (symptoms, concepts) scores in one pooling mode, with the encoder time and token count it took
+    """
+    retriever.TERM_POOLING = pooling
+    units = [retriever.description_units(description) for description in descriptions]
+    owners = torch.tensor([concept for concept, concept_units in enumerate(units) for _ in concept_units])
+    texts = [unit for concept_units in units for unit in concept_units]
+
+    tokens = sum(len(ids) for ids in tokenizer(texts, truncation="longest_first", max_length=512)["input_ids"])
+    start = time.perf_counter()
+    embeddings = encode_batch(tokenizer, model, texts)
+    seconds = time.perf_counter() - start
+
+    symptoms = encode_batch(tokenizer, model, SYMPTOMS)
+    return pool_scores(cosine_scores(symptoms, embeddings), owners, len(descriptions), pooling), seconds, tokens
+
+
+def main():
+    sample = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    descriptions = pd.read_csv(sys.argv[1], usecols=["descriptions"], dtype=str, nrows=sample)["descriptions"].fillna("").tolist()
+    tokenizer, model = registry.get()
+
+    results, rankings = {}, {}
+    for pooling in ["none", "max", "mean"]:
+        scores, seconds, tokens = score(tokenizer, model, descriptions, pooling)
+        rankings[pooling] = scores.topk(TOP_K, dim=1).indices
+        results[pooling] = {"concepts_per_sec": round(len(descriptions) / seconds, 1), "tokens": tokens, "seconds": round(seconds, 2)}
+
+    # Share of the blob top-k that each term mode also ranks in its top-k, averaged over symptoms
+    for pooling in ["max", "mean"]:
+        overlap = [len(set(a.tolist()) & set(b.tolist())) / TOP_K for a, b in zip(rankings["none"], rankings[pooling])]
+        results[pooling]["top_k_agreement_with_none"] = round(sum(overlap) / len(overlap), 3)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import pandas as pd
+import gzip
+import os
+import re
+import sys
+
+
+# File written by build_matcher and loaded by main.py at startup
+SYMPTOM_MATCHER_PATH = os.getenv("SYMPTOM_MATCHER_PATH", "symptom_matcher.txt.gz")
+
+# Longest term, in tokens, that is worth looking for in a user message
+MAX_TERM_TOKENS = 8
+
+TOKEN = re.compile(r"[a-z0-9]+(?:['-][a-z0-9]+)*")
+
+# Fully specified names end with their hierarchy, e.g. "Fever (finding)". Shared with retriever and the
+# graph snapshot export, so every consumer strips exactly the same suffix
+SEMANTIC_TAG = re.compile(r"\s*\(([^()]*)\)\s*$")
+
+# Only concepts of these SNOMED hierarchies are terms a user would mention
+ALLOWED_TAGS = {
+    "finding", "disorder", "disease", "substance", "product", "medicinal product", "clinical drug",
+    "procedure", "regime/therapy", "body structure", "organism", "morphologic abnormality", "situation",
+}
+
+# Single words that are SNOMED terms but carry no medical meaning in a sentence
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "had", "has", "have",
+    "he", "her", "his", "i", "if", "in", "is", "it", "me", "my", "no", "not", "of", "on", "or", "she", "so",
+    "that", "the", "their", "they", "this", "to", "was", "we", "what", "when", "with", "you", "your",
+}
+
+
+def normalize(text:str) -> tuple:
+    """
+    Lowercased word tokens, the form terms are stored and matched in
+    """
+    return tuple(TOKEN.findall(text.lower()))
+
+
+def concept_terms(descriptions:str) -> list[str]:
+    """
+    Terms of one concept from its ';'-joined descriptions, or nothing if the concept is outside ALLOWED_TAGS.
+    The fully specified name carries the hierarchy as a trailing "(tag)".
+    """
+    terms = [term for term in descriptions.split(";") if term.strip()]
+    tags = [match.group(1) for match in map(SEMANTIC_TAG.search, terms) if match]
+    if tags and not any(tag in ALLOWED_TAGS for tag in tags):
+        return []
+    return [SEMANTIC_TAG.sub("", term) for term in terms]
+
+
+class SymptomMatcher:
+    """
+    Dictionary matcher over normalized SNOMED terms. Every n-gram of the message, longest first,
+    is looked up in a hash set, and matches are taken leftmost-longest without overlap.
+    """
+
+    def __init__(self, terms:set):
+        self.terms = terms
+        self.max_tokens = max((len(term.split()) for term in terms), default=0)
+
+    @classmethod
+    def load(cls, path:str=SYMPTOM_MATCHER_PATH):
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            return cls({line.rstrip("\n") for line in file})
+
+    def save(self, path:str=SYMPTOM_MATCHER_PATH):
+        with gzip.open(path, "wt", encoding="utf-8") as file:
+            for term in sorted(self.terms):
+                file.write(term + "\n")
+
+    def extract(self, text:str) -> list[str]:
+        """
+        Medical terms found in text, in order of appearance and without repeats
+        """
+        tokens = normalize(text)
+        found = []
+
+        start = 0
+        while start < len(tokens):
+            for length in range(min(self.max_tokens, len(tokens) - start), 0, -1):
+                candidate = " ".join(tokens[start:start + length])
+                if candidate in self.terms:
+                    if candidate not in found:
+                        found.append(candidate)
+                    start += length
+                    break
+            else:
+                start += 1
+
+        return found
+
+
+def build_matcher(merged_nodes:str="CSVItem/merged_nodes.csv", chunksize:int=100000) -> SymptomMatcher:
+    """
+    Build the matcher from the merged_nodes.csv written by graphConstruction/medical_rag.py combine_nodes()
+    """
+    terms = set()
+    for chunk in pd.read_csv(merged_nodes, usecols=["descriptions"], dtype=str, chunksize=chunksize):
+        for descriptions in chunk["descriptions"].dropna():
+            for term in concept_terms(descriptions):
+                tokens = normalize(term)
+                if not tokens or len(tokens) > MAX_TERM_TOKENS:
+                    continue
+                if len(tokens) == 1 and (tokens[0] in STOPWORDS or len(tokens[0]) < 3):
+                    continue
+                terms.add(" ".join(tokens))
+
+    return SymptomMatcher(terms)
+
+
+if __name__ == "__main__":
+    matcher = build_matcher(*sys.argv[1:2])
+    matcher.save()
+    print(f"Saved {len(matcher.terms)} terms to {SYMPTOM_MATCHER_PATH}.")
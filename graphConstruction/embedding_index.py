@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Offline build of the node embedding index used by retriever.py.
+
+Run from the repository root after the graph has been populated:
+    python graphConstruction/embedding_index.py
+
+After a delta ingest, only re-encode the concepts it changed:
+    python graphConstruction/embedding_index.py --update delta_changes.json
+"""
+from neo4j import GraphDatabase
+from pathlib import Path
+import numpy as np
+import json
+import os
+import sys
+import time
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from retriever import registry, encode_batch, graph_version, description_units, index_granularity, MODEL_NAME, MODEL_REVISION, MODEL_PRECISION, EMBED_INDEX_DIR
+
+
+def encode_units(tokenizer, model, descriptions):
+  """
+  Normalized float16 vectors of every unit of the descriptions, and how many units each one has
+  """
+  units = [description_units(description) for description in descriptions]
+  embeddings = encode_batch(tokenizer, model, [unit for node_units in units for unit in node_units])
+  embeddings = embeddings / embeddings.norm(dim=-1, keepdim=True).clamp(min=1e-12)
+  return embeddings.numpy().astype(np.float16), [len(node_units) for node_units in units]
+
+
+def stream_descriptions(driver, batch_size):
+  """
+  Yields (ids, descriptions) batches without holding the whole corpus in memory
+  """
+  with driver.session(fetch_size=batch_size) as session:
+    result = session.run("MATCH (n:Nodes) RETURN n.id AS id, n.descriptions AS descriptions ORDER BY n.id")
+
+    ids, descriptions = [], []
+    for record in result:
+      ids.append(record["id"])
+      descriptions.append(record["descriptions"] if isinstance(record["descriptions"], str) else "")
+
+      if len(ids) == batch_size:
+        yield ids, descriptions
+        ids, descriptions = [], []
+
+    if ids:
+      yield ids, descriptions
+
+
+def build_index(driver, output=EMBED_INDEX_DIR, batch_size=1024):
+  """
+  Encodes every node description into a float16 memory-mapped matrix with an id-to-rows mapping.
+  With term pooling every synonym gets its own row, node row r owns vectors[starts[r]:ends[r]].
+  Vectors are stored L2-normalized so scoring at query time is a plain dot product.
+  """
+  output = Path(output)
+  output.mkdir(parents=True, exist_ok=True)
+  tokenizer, model = registry.get()
+
+  with driver.session() as session:
+    version = session.execute_read(graph_version)
+
+  # First pass only splits the text, to size the files before any encoding
+  total, total_units = 0, 0
+  for batch_ids, batch_descriptions in stream_descriptions(driver, batch_size):
+    total += len(batch_ids)
+    total_units += sum(len(description_units(description)) for description in batch_descriptions)
+
+  vectors = np.lib.format.open_memmap(output / "vectors.npy", mode="w+", dtype=np.float16, shape=(total_units, model.config.hidden_size))
+  ids = np.lib.format.open_memmap(output / "ids.npy", mode="w+", dtype=np.int64, shape=(total,))
+  starts = np.lib.format.open_memmap(output / "starts.npy", mode="w+", dtype=np.int64, shape=(total,))
+  ends = np.lib.format.open_memmap(output / "ends.npy", mode="w+", dtype=np.int64, shape=(total,))
+
+  row, unit = 0, 0
+  start = time.time()
+  for batch_ids, batch_descriptions in stream_descriptions(driver, batch_size):
+    embeddings, counts = encode_units(tokenizer, model, batch_descriptions)
+
+    vectors[unit:unit + len(embeddings)] = embeddings
+    ids[row:row + len(batch_ids)] = batch_ids
+    ends[row:row + len(batch_ids)] = unit + np.cumsum(counts)
+    starts[row:row + len(batch_ids)] = ends[row:row + len(batch_ids)] - counts
+    row += len(batch_ids)
+    unit += len(embeddings)
+    print(f"Encoded {row} of {total} nodes ({row / (time.time() - start):.1f} nodes/sec).")
+
+  for array in (vectors, ids, starts, ends):
+    array.flush()
+
+  # Written last so a partial build is never picked up as valid
+  meta = {"graph_version": version, "model": MODEL_NAME, "revision": MODEL_REVISION, "precision": MODEL_PRECISION, "granularity": index_granularity(), "rows": row, "units": unit, "dim": model.config.hidden_size}
+  with open(output / "meta.json", "w") as file:
+    json.dump(meta, file)
+
+
+def fetch_descriptions(transaction, ids):
+  """
+  Current descriptions of the given ids that are still in the Nodes layer
+  """
+  result = transaction.run("MATCH (n:Nodes) WHERE n.id IN $ids RETURN n.id AS id, n.descriptions AS descriptions", ids=ids)
+  return [(record["id"], record["descriptions"] if isinstance(record["descriptions"], str) else "") for record in result]
+
+
+def grow(path, rows, chunk=100000):
+  """
+  Copies a .npy file into one with rows more rows, returning the new memory map
+  """
+  old = np.load(path, mmap_mode="r")
+  new = np.lib.format.open_memmap(path.with_suffix(".new.npy"), mode="w+", dtype=old.dtype, shape=(len(old) + rows,) + old.shape[1:])
+  for start in range(0, len(old), chunk):
+    new[start:start + chunk] = old[start:start + chunk]
+  return new
+
+
+def update_index(driver, changes_path, output=EMBED_INDEX_DIR, batch_size=1024):
+  """
+  Re-encodes only the ids listed by medical_rag.delta_ingest. Their new unit vectors are appended and
+  their starts/ends repointed, since a changed concept can have a different number of terms; new concepts
+  are appended too, and retired ones keep rows that the retriever can no longer reach.
+  The old rows are copied, never re-encoded.
+  Only an index built from the graph the delta started from can be updated, after a skipped delta it has to be rebuilt.
+  """
+  output = Path(output)
+  with open(changes_path) as file:
+    changes = json.load(file)
+  with open(output / "meta.json") as file:
+    meta = json.load(file)
+
+  if meta.get("graph_version") == changes["graph_version"]:
+    print("The index already includes this delta.")
+    return
+  if meta.get("graph_version") != changes.get("previous_graph_version"):
+    raise ValueError(f"The index was built from graph version {meta.get('graph_version')} but the delta starts from {changes.get('previous_graph_version')}, rebuild it with build_index.")
+
+  tokenizer, model = registry.get()
+  rows = {int(node_id): row for row, node_id in enumerate(np.load(output / "ids.npy"))}
+
+  updated_ids, updated_vectors, updated_counts = [], [], []
+  for i in range(0, len(changes["ids"]), batch_size):
+    with driver.session() as session:
+      batch = session.execute_read(fetch_descriptions, changes["ids"][i:i + batch_size])
+
+    if batch:
+      embeddings, counts = encode_units(tokenizer, model, [descriptions for _, descriptions in batch])
+      updated_ids.extend(node_id for node_id, _ in batch)
+      updated_vectors.append(embeddings)
+      updated_counts.extend(counts)
+
+  if not updated_ids:
+    print("No indexed nodes changed.")
+  else:
+    appended = [node_id for node_id in updated_ids if node_id not in rows]
+    embeddings = np.concatenate(updated_vectors)
+
+    vectors = grow(output / "vectors.npy", len(embeddings))
+    ids = grow(output / "ids.npy", len(appended))
+    starts = grow(output / "starts.npy", len(appended))
+    ends = grow(output / "ends.npy", len(appended))
+
+    first_unit = len(vectors) - len(embeddings)
+    vectors[first_unit:] = embeddings
+    for position, node_id in enumerate(appended):
+      rows[node_id] = len(ids) - len(appended) + position
+      ids[rows[node_id]] = node_id
+
+    unit_ends = first_unit + np.cumsum(updated_counts)
+    for node_id, count, unit_end in zip(updated_ids, updated_counts, unit_ends):
+      starts[rows[node_id]] = unit_end - count
+      ends[rows[node_id]] = unit_end
+
+    for name, array in (("vectors", vectors), ("ids", ids), ("starts", starts), ("ends", ends)):
+      array.flush()
+      os.replace(output / f"{name}.new.npy", output / f"{name}.npy")
+    meta["units"] = len(vectors)
+    print(f"Re-encoded {len(updated_ids)} nodes, {len(appended)} of them new.")
+
+  meta.update({"graph_version": changes["graph_version"], "rows": len(rows)})
+  with open(output / "meta.json", "w") as file:
+    json.dump(meta, file)
+
+
+def main():
+  uri = os.getenv("NEO4J_URI", "bolt://localhost:7687")
+  username = os.getenv("NEO4J_USER")
+  password = os.getenv("NEO4J_PASS")
+
+  with GraphDatabase.driver(uri, auth=(username, password)) as driver:
+    if "--update" in sys.argv:
+      update_index(driver, sys.argv[sys.argv.index("--update") + 1])
+    else:
+      build_index(driver)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Export the concept graph as compressed sparse rows for the retriever's snapshot backend.
+
+Run from the repository root after the graph has been populated:
+    python graphConstruction/graph_snapshot.py
+"""
+from neo4j import GraphDatabase
+from pathlib import Path
+import numpy as np
+import json
+import os
+import sys
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from retriever import graph_version, term_hash, tokens, GRAPH_SNAPSHOT_DIR
+
+
+def token_hashes(descriptions:str) -> set:
+  """
+  Every token of every synonym, semantic tags included as the full-text index does
+  """
+  return {term_hash(token) for token in tokens(descriptions)}
+
+
+def export_nodes(driver, batch_size):
+  """
+  Node ids, the UTF-8 description table and the (token hash, row) pairs of every concept
+  """
+  ids, text_offsets, hashes, hash_rows = [], [0], [], []
+  text = bytearray()
+
+  with driver.session(fetch_size=batch_size) as session:
+    result = session.run("MATCH (n:Nodes) RETURN n.id AS id, n.descriptions AS descriptions ORDER BY n.id")
+
+    for row, record in enumerate(result):
+      descriptions = record["descriptions"] if isinstance(record["descriptions"], str) else ""
+      ids.append(record["id"])
+      text.extend(descriptions.encode("utf-8"))
+      text_offsets.append(len(text))
+
+      for key in token_hashes(descriptions):
+        hashes.append(key)
+        hash_rows.append(row)
+
+  return ids, text_offsets, text, hashes, hash_rows
+
+
+def export_edges(driver, rows, batch_size):
+  """
+  Source rows, destination rows and relationship type names of every edge between Nodes
+  """
+  sources, destinations, types = [], [], []
+
+  with driver.session(fetch_size=batch_size) as session:
+    result = session.run("""
+      MATCH (a:Nodes)-[r]->(b:Nodes)
+      RETURN a.id AS source, b.id AS destination, coalesce(r.relationshipType, type(r)) AS type
+    """)
+
+    for record in result:
+      if record["source"] in rows and record["destination"] in rows:
+        sources.append(rows[record["source"]])
+        destinations.append(rows[record["destination"]])
+        types.append(record["type"])
+
+  return sources, destinations, types
+
+
+def build_snapshot(driver, output=GRAPH_SNAPSHOT_DIR, batch_size=10000):
+  """
+  Writes offsets, neighbors and edge_types as CSR arrays (edges in both directions, since the
+  expansion is undirected), the description table and the token inverted index as .npy files.
+  """
+  with driver.session() as session:
+    version = session.execute_read(graph_version)
+
+  ids, text_offsets, text, hashes, hash_rows = export_nodes(driver, batch_size)
+  rows = {node_id: row for row, node_id in enumerate(ids)}
+  print(f"Exported {len(ids)} nodes.")
+
+  sources, destinations, type_names = export_edges(driver, rows, batch_size)
+  print(f"Exported {len(sources)} edges.")
+
+  write_snapshot(output, version, ids, text_offsets, text, hashes, hash_rows, sources, destinations, type_names)
+
+
+def write_snapshot(output, version, ids, text_offsets, text, hashes, hash_rows, sources, destinations, type_names):
+  """
+  Lay the exported nodes and edges out in the files GraphSnapshot maps
+  """
+  output = Path(output)
+  output.mkdir(parents=True, exist_ok=True)
+
+  # Edge types become small integer codes
+  edge_types = sorted(set(type_names))
+  codes = {name: code for code, name in enumerate(edge_types)}
+  types = np.array([codes[name] for name in type_names], dtype=np.int8)
+
+  source = np.concatenate([np.array(sources, dtype=np.int32), np.array(destinations, dtype=np.int32)])
+  destination = np.concatenate([np.array(destinations, dtype=np.int32), np.array(sources, dtype=np.int32)])
+  types = np.concatenate([types, types])
+
+  # Group edges by source row, offsets[row]:offsets[row + 1] are the edges of row
+  order = np.argsort(source, kind="stable")
+  offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+  np.cumsum(np.bincount(source, minlength=len(ids)), out=offsets[1:])
+
+  order_tokens = np.argsort(np.array(hashes, dtype=np.int64), kind="stable")
+
+  np.save(output / "offsets.npy", offsets)
+  np.save(output / "neighbors.npy", destination[order])
+  np.save(output / "edge_types.npy", types[order])
+  np.save(output / "node_ids.npy", np.array(ids, dtype=np.int64))
+  np.save(output / "text_offsets.npy", np.array(text_offsets, dtype=np.int64))
+  np.save(output / "text.npy", np.frombuffer(bytes(text), dtype=np.uint8))
+  np.save(output / "token_hashes.npy", np.array(hashes, dtype=np.int64)[order_tokens])
+  np.save(output / "token_rows.npy", np.array(hash_rows, dtype=np.int32)[order_tokens])
+
+  # Written last so a partial export is never picked up as valid
+  meta = {"graph_version": version, "nodes": len(ids), "edges": int(len(source)), "edge_types": edge_types}
+  with open(output / "meta.json", "w") as file:
+    json.dump(meta, file)
+
+
+def main():
+  uri = os.getenv("NEO4J_URI", "bolt://localhost:7687")
+  username = os.getenv("NEO4J_USER")
+  password = os.getenv("NEO4J_PASS")
+
+  with GraphDatabase.driver(uri, auth=(username, password)) as driver:
+    build_snapshot(driver)
+
+
+if __name__ == "__main__":
+  main()
@@ -2,8 +2,16 @@
 import pandas as pd
 from neo4j import GraphDatabase
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import csv
+import json
 import os
+import resource
+import tempfile
+import time
 
 
 def colab_requirements():
@@ -31,151 +39,472 @@ def local_requirements():
   return nodes, description, relationships
 
 
-def to_csv(nodes, description, relationships):
+def to_csv(nodes, description, relationships, chunksize=500000):
   """
-  Convert files to CSV and download them locally.
+  Convert files to CSV and Parquet locally, streamed in chunks.
   """
-  nodes.to_csv("nodes.csv", index=False)
-  description.to_csv("description.csv", index=False)
-  relationships.to_csv("relationship.csv", index=False)
+  # The raw description file still has stray commas, it is typed once fixDescription() has cleaned it
+  for source, output, dtype in [(nodes, "nodes", SNOMED_DTYPES), (description, "description", str), (relationships, "relationship", SNOMED_DTYPES)]:
+    writer = TableWriter(f"{output}.csv", f"{output}.parquet")
+    for chunk in pd.read_csv(source, dtype=dtype, chunksize=chunksize):
+      writer.write(chunk)
+    writer.close()
 
 
 def create_indexes(transaction):
   """
   Creates indices over the most used database properties
   """
-  transaction.run("CREATE INDEX FOR (c:Concept) ON (c.id);")
-  transaction.run("CREATE INDEX FOR (r:Relationship) ON (r.sourceId);")
-  transaction.run("CREATE INDEX FOR (r:Relationship) ON (r.destinationId);")
-  transaction.run("CREATE INDEX FOR (r:Relationship) ON (r.typeId);")
-
-
-def populate_nodes(transaction, nodes, descriptions, batch_size=1000):
-  """
-  Populates the nodes and descriptions
-  """
-
-  # Populates the nodes first
-  for i in range(0, len(nodes), batch_size):
-      batch = nodes.iloc[i:i + batch_size]
-      print(f"Processing batch {i // batch_size + 1} of {len(nodes) // batch_size + 1} Concept nodes.")  # Print batch info
-      
-      concept_query = """
-      UNWIND $batch AS row
-      CREATE (:Concept {
-          id: row.id, 
-          effectiveTime: row.effectiveTime, 
-          moduleId: row.moduleId, 
-          active: row.active, 
-          definitionStatusId: row.definitionStatusId
-      })
-      """
-      
-      transaction.run(concept_query, batch=batch.to_dict('records'))
-      print(f"Batch {i // batch_size + 1}: Created {len(batch)} Concept nodes.")
-  
-  # Next populates the descriptions that correspond with the nodes
-  for i in range(0, len(descriptions), batch_size):
-    batch = descriptions.iloc[i:i + batch_size]
-    print(f"Processing batch {i // batch_size + 1} of {len(descriptions) // batch_size + 1} Descriptions.")
-    
-    # Create Description nodes and link them to Concept nodes in one step using UNWIND
-    query = """
-      UNWIND $batch AS row
-      MERGE (d:Description {descriptionId: row.id})
-      SET d.term = row.term, 
-          d.languageCode = row.languageCode, 
-          d.typeId = row.typeId, 
-          d.caseSignificanceId = row.caseSignificanceId
-      
-      WITH d, row
-      MERGE (c:Concept {id: row.conceptId})
-      MERGE (c)-[:HAS_DESCRIPTION]->(d)
-    """
+  transaction.run("CREATE INDEX IF NOT EXISTS FOR (c:Concept) ON (c.id);")
+  transaction.run("CREATE INDEX IF NOT EXISTS FOR (d:Description) ON (d.descriptionId);")
+  transaction.run("CREATE INDEX IF NOT EXISTS FOR (r:Relationship) ON (r.sourceId);")
+  transaction.run("CREATE INDEX IF NOT EXISTS FOR (r:Relationship) ON (r.destinationId);")
+  transaction.run("CREATE INDEX IF NOT EXISTS FOR (r:Relationship) ON (r.typeId);")
+  transaction.run("CREATE INDEX IF NOT EXISTS FOR (n:Nodes) ON (n.id);")
+  transaction.run("CREATE INDEX IF NOT EXISTS FOR (n:RetiredNodes) ON (n.id);")
+  transaction.run("CREATE INDEX IF NOT EXISTS FOR ()-[r:RELATIONSHIP]-() ON (r.id);")
 
-    transaction.run(query, batch=batch.to_dict('records'))
-    print(f"Batch {i // batch_size + 1}: Created and linked {len(batch)} Description nodes.")
 
+def create_fulltext_index(transaction):
+  """
+  Full-text index over the node descriptions used to find the seed nodes of a symptom.
+  The standard analyzer lowercases and splits on punctuation, so every ';'-joined term is tokenized on its own.
+  """
+  transaction.run("""
+    CREATE FULLTEXT INDEX nodeDescriptions IF NOT EXISTS
+    FOR (n:Nodes) ON EACH [n.descriptions]
+    OPTIONS {indexConfig: {`fulltext.analyzer`: 'standard-no-stop-words'}}
+  """)
 
-def populate_relationships(transaction, relationships, batch_size=500):
-    """
-    Populates the relationships between nodes. There are four types of relationships that are seen in the relation_update() function.
-    """
 
-    # Go through relationship and create the relations between nodes
-    for i in range(0, len(relationships), batch_size):
-        batch = relationships.iloc[i:i + batch_size]
-        print(f"Processing batch {i//batch_size + 1} of {len(relationships)//batch_size + 1} relationships")
-        
-        query = """
-            UNWIND $batch AS row
-            MATCH (source:Concept {id: row.sourceId}), (destination:Concept {id: row.destinationId})
-            CREATE (source)-[:RELATIONSHIP {
-                typeId: row.typeId,
-                relationshipGroup: row.relationshipGroup,
-                characteristicTypeId: row.characteristicTypeId,
-                modifierId: row.modifierId
-            }]->(destination)
-            """
+def record_build(transaction, version, watermark=None):
+  """
+  Stamps the graph with a build version so derived artifacts such as the embedding index can tell when they are stale.
+  The watermark is the latest effectiveTime ingested, the starting point of the next delta.
+  """
+  transaction.run("MERGE (b:GraphBuild) SET b.version = $version, b.watermark = coalesce($watermark, b.watermark)", version=version, watermark=watermark)
+
+
+# Idempotent upserts, so a resumed batch can safely be written twice
+CONCEPT_UPSERT = """
+  UNWIND $batch AS row
+  MERGE (c:Concept {id: row.id})
+  SET c.effectiveTime = row.effectiveTime,
+      c.moduleId = row.moduleId,
+      c.active = row.active,
+      c.definitionStatusId = row.definitionStatusId
+"""
+
+DESCRIPTION_UPSERT = """
+  UNWIND $batch AS row
+  MERGE (d:Description {descriptionId: row.id})
+  SET d.term = row.term,
+      d.languageCode = row.languageCode,
+      d.typeId = row.typeId,
+      d.caseSignificanceId = row.caseSignificanceId
+  WITH d, row
+  MERGE (c:Concept {id: row.conceptId})
+  MERGE (c)-[:HAS_DESCRIPTION]->(d)
+"""
+
+RELATIONSHIP_UPSERT = """
+  UNWIND $batch AS row
+  MATCH (source:Concept {id: row.sourceId}), (destination:Concept {id: row.destinationId})
+  MERGE (source)-[r:RELATIONSHIP {id: row.id}]->(destination)
+  SET r.typeId = row.typeId,
+      r.relationshipGroup = row.relationshipGroup,
+      r.characteristicTypeId = row.characteristicTypeId,
+      r.modifierId = row.modifierId
+"""
+
+
+def write_batch(transaction, query, batch):
+  """
+  Writes one batch, each call is its own transaction
+  """
+  transaction.run(query, batch=batch)
 
-        transaction.run(query, batch=batch.to_dict('records'))
 
+def load_checkpoint(path):
+  """
+  Rows already committed for each file of an interrupted ingest
+  """
+  if not os.path.exists(path):
+    return {}
+  with open(path) as file:
+    return json.load(file)
 
-def relation_update():
+
+def save_checkpoint(path, checkpoint):
+  # Write then rename so a crash never leaves a half written checkpoint
+  with open(path + ".tmp", "w") as file:
+    json.dump(checkpoint, file)
+  os.replace(path + ".tmp", path)
+
+
+def skip_rows(chunks, count):
   """
-  The original relationship.csv contains numerical values so modified_relationship.csv contains the actual word for which each node corresponds to.
+  Drops the first count rows of a chunk stream, for formats that can't skip while reading
+  """
+  for chunk in chunks:
+    if count >= len(chunk):
+      count -= len(chunk)
+      continue
+    yield chunk.iloc[count:]
+    count = 0
+
+
+def ingest_file(driver, name, path, query, checkpoint, checkpoint_path, batch_size=5000, workers=1, partition_key=None, sep=","):
+  """
+  Streams one CSV into the graph batch by batch. Every batch is committed in its own transaction and
+  the checkpoint records the rows done, so an interrupted load continues where it stopped.
+  With workers > 1 each chunk is split by partition_key so concurrent sessions write disjoint source nodes.
+  """
+  done = checkpoint.get(name, 0)
+  if done:
+    print(f"Resuming {name} after {done} rows.")
+
+  start = time.time()
+  written = 0
+  chunks = read_chunks(path, batch_size * workers, sep=sep, dtype=SNOMED_DTYPES, skiprows=range(1, done + 1))
+  if str(path).endswith(".parquet"):
+    chunks = skip_rows(chunks, done)
+
+  # Sessions are not thread safe, every batch opens its own
+  def write(batch):
+    with driver.session() as session:
+      session.execute_write(write_batch, query, batch)
+
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    for chunk in chunks:
+      # Missing values go to Neo4j as null
+      chunk = chunk.astype(object).where(chunk.notna(), None)
+
+      if partition_key is not None and workers > 1:
+        # Rows of one source node always land in the same batch, so concurrent sessions never contend on a
+        # source node. MERGE on a relationship also locks the destination, which can sit in any batch, so
+        # contention on shared destinations remains and the driver retries those transactions
+        groups = chunk.groupby(chunk[partition_key].map(hash) % workers)
+        batches = [group.to_dict("records") for _, group in groups]
+      else:
+        batches = [chunk.iloc[i:i + batch_size].to_dict("records") for i in range(0, len(chunk), batch_size)]
+
+      list(pool.map(write, batches))
+
+      done += len(chunk)
+      written += len(chunk)
+      checkpoint[name] = done
+      save_checkpoint(checkpoint_path, checkpoint)
+      print(f"{name}: {done} rows committed ({written / (time.time() - start):.0f} rows/sec).")
+
+
+def ingest(driver, nodes_path, descriptions_path, relationships_path, checkpoint_path="ingest_checkpoint.json", batch_size=5000, workers=4):
+  """
+  Streaming, resumable load of the nodes, descriptions and relationships, in batches of their own transactions
   """
+  # Indexes go in first, in their own transaction, so the MERGE/MATCH lookups below use them
+  with driver.session() as session:
+    session.execute_write(create_indexes)
+
+  checkpoint = load_checkpoint(checkpoint_path)
+  ingest_file(driver, "nodes", nodes_path, CONCEPT_UPSERT, checkpoint, checkpoint_path, batch_size)
+  ingest_file(driver, "descriptions", descriptions_path, DESCRIPTION_UPSERT, checkpoint, checkpoint_path, batch_size)
+  ingest_file(driver, "relationships", relationships_path, RELATIONSHIP_UPSERT, checkpoint, checkpoint_path, batch_size, workers, partition_key="sourceId")
 
-  # Mapping the relationship number to the word
-  relationship_group_mapping = {
-    0: "ATTRIBUTE",
-    1: 'IS_A',
-    2: 'PART_OF',
-    3: 'ASSOCIATED_WITH',
-    4: 'CAUSES',
-    5: 'FOUND_AT',
-    6: "TEMPORAL"
-  }
-
-  # Not all the columns are needed
-  columns_to_drop = [
-      "id",
-      "effectiveTime",
-      "active",
-      "moduleId",
-      "relationshipGroup",
-      "typeId",
-      "characteristicTypeId",
-      "modifierId"
+  # A completed load starts from scratch next time, nothing was written if every file was empty or already done
+  if os.path.exists(checkpoint_path):
+    os.remove(checkpoint_path)
+
+
+def export_admin_import(nodes_path, descriptions_path, relationships_path, output="import", chunksize=100000):
+  """
+  Writes the CSV layout `neo4j-admin database import` expects, for full offline rebuilds:
+    neo4j-admin database import full --id-type=INTEGER --nodes=import/concepts.csv --nodes=import/descriptions.csv
+      --relationships=import/has_description.csv --relationships=import/relationships.csv
+  The headers carry the property types and --id-type=INTEGER stores the ids as integers,
+  so the graph has the same types as one built by ingest() and the id lookups keep matching.
+  """
+  output = Path(output)
+  output.mkdir(parents=True, exist_ok=True)
+
+  layouts = [
+    (nodes_path, "concepts.csv", {"id": "id:ID(Concept)", "effectiveTime": "effectiveTime:long", "moduleId": "moduleId:long", "active": "active:int", "definitionStatusId": "definitionStatusId:long"}, {":LABEL": "Concept"}),
+    (descriptions_path, "descriptions.csv", {"id": "descriptionId:ID(Description)", "term": "term", "languageCode": "languageCode", "typeId": "typeId:long", "caseSignificanceId": "caseSignificanceId:long"}, {":LABEL": "Description"}),
+    (descriptions_path, "has_description.csv", {"conceptId": ":START_ID(Concept)", "id": ":END_ID(Description)"}, {":TYPE": "HAS_DESCRIPTION"}),
+    (relationships_path, "relationships.csv", {"sourceId": ":START_ID(Concept)", "destinationId": ":END_ID(Concept)", "id": "id:long", "typeId": "typeId:long", "relationshipGroup": "relationshipGroup:long", "characteristicTypeId": "characteristicTypeId:long", "modifierId": "modifierId:long"}, {":TYPE": "RELATIONSHIP"}),
   ]
-  
-  # Let pandas go over the CSV
-  relationships_df = pd.read_csv('CSVItems/relationship.csv')
 
-  # Maps and deletes columns
-  relationships_df['relationshipType'] = relationships_df['relationshipGroup'].map(relationship_group_mapping)
-  relationships_df.drop(columns=columns_to_drop, inplace=True)
+  for source, target, columns, constants in layouts:
+    header = True
+    # Parsing the ids as integers rejects a malformed row here rather than halfway through the import
+    dtype = {column: SNOMED_DTYPES[column] for column in columns}
+    for chunk in read_chunks(source, chunksize, list(columns), dtype=dtype, keep_default_na=False):
+      chunk = chunk[list(columns)].rename(columns=columns)
+      for column, value in constants.items():
+        chunk[column] = value
+      chunk.to_csv(output / target, mode="w" if header else "a", header=header, index=False)
+      header = False
+    print(f"Wrote {output / target}.")
+
+
+# Delta queries, all idempotent so a release can be re-applied safely
+DESCRIPTION_RETIRE = """
+  UNWIND $batch AS row
+  MATCH (d:Description {descriptionId: row.id})
+  DETACH DELETE d
+"""
+
+RELATIONSHIP_DELTA = """
+  UNWIND $batch AS row
+  MATCH (source:Concept {id: row.sourceId}), (destination:Concept {id: row.destinationId})
+  MERGE (source)-[r:RELATIONSHIP {id: row.id}]->(destination)
+  SET r.typeId = row.typeId,
+      r.relationshipGroup = row.relationshipGroup,
+      r.characteristicTypeId = row.characteristicTypeId,
+      r.modifierId = row.modifierId
+  WITH row
+  MATCH (a:Nodes {id: row.sourceId}), (b:Nodes {id: row.destinationId})
+  MERGE (a)-[e:RELATIONSHIP {id: row.id}]->(b)
+  SET e.relationshipType = row.relationshipType
+"""
+
+# Anchored on the indexed source node, in the Concept layer and in the Nodes layer whichever label it has now
+RELATIONSHIP_RETIRE = """
+  UNWIND $batch AS row
+  OPTIONAL MATCH (:Concept {id: row.sourceId})-[r:RELATIONSHIP {id: row.id}]->()
+  DELETE r
+  WITH DISTINCT row
+  OPTIONAL MATCH (:Nodes {id: row.sourceId})-[e:RELATIONSHIP {id: row.id}]->()
+  DELETE e
+  WITH DISTINCT row
+  OPTIONAL MATCH (:RetiredNodes {id: row.sourceId})-[f:RELATIONSHIP {id: row.id}]->()
+  DELETE f
+"""
+
+# Rebuild the ';'-joined descriptions of changed concepts, and move each concept's node to the layer
+# matching its active flag. A concept retired earlier keeps its node, and its edges, when it comes back
+NODES_REFRESH = """
+  UNWIND $ids AS id
+  MATCH (c:Concept {id: id})
+  OPTIONAL MATCH (c)-[:HAS_DESCRIPTION]->(d:Description)
+  WITH c, collect(d.term) AS terms
+  OPTIONAL MATCH (retired:RetiredNodes {id: c.id})
+  FOREACH (_ IN CASE WHEN retired IS NULL THEN [1] ELSE [] END | MERGE (:Nodes {id: c.id}))
+  WITH c, terms, retired
+  OPTIONAL MATCH (current:Nodes {id: c.id})
+  WITH c, terms, coalesce(current, retired) AS n
+  SET n.active = c.active,
+      n.descriptions = reduce(joined = head(terms), term IN tail(terms) | joined + ';' + term)
+  FOREACH (_ IN CASE WHEN c.active = 1 THEN [1] ELSE [] END | REMOVE n:RetiredNodes SET n:Nodes)
+  FOREACH (_ IN CASE WHEN c.active = 0 THEN [1] ELSE [] END | REMOVE n:Nodes SET n:RetiredNodes)
+"""
+
+
+def graph_watermark(transaction):
+  """
+  Latest effectiveTime already in the graph
+  """
+  record = transaction.run("MATCH (b:GraphBuild) RETURN b.watermark AS watermark").single()
+  return record["watermark"] if record else None
 
-  # Finally, convert the fixes to a new modified_relationship.csv file
-  relationships_df.to_csv('modified_relationship.csv', index=False)
 
+def graph_build_version(transaction):
+  """
+  Version stamped by the last full or delta build
+  """
+  record = transaction.run("MATCH (b:GraphBuild) RETURN b.version AS version").single()
+  return record["version"] if record else None
 
-def fixDescription(description):
+
+def release_watermark(*paths, chunksize=1000000):
   """
-  Description CSV has errors has the term column has commas within the term segment. Additionally, there are quotations which were removed manually. 
+  Latest effectiveTime of a release, read column-only
   """
+  latest = 0
+  for path in paths:
+    for chunk in read_chunks(path, chunksize, ["effectiveTime"], dtype=SNOMED_DTYPES):
+      latest = max(latest, int(chunk["effectiveTime"].max()))
+  return latest
 
-  # nodes = pd.read_csv(node, sep='\t', dtype=str)
-  # relationships = pd.read_csv(relationship, sep='\t', dtype=str)
 
-  with open(description, 'r', encoding='utf-8') as file:
-        content = file.read().replace(',', '')
-        
-  with open(description, 'w', encoding='utf-8') as file:
-        file.write(content)
+def changed_rows(path, watermark, chunksize):
+  """
+  Yields the rows of a release newer than the watermark, split into active and inactive ones
+  """
+  for chunk in read_chunks(path, chunksize, dtype=SNOMED_DTYPES):
+    chunk = chunk[chunk["effectiveTime"] > watermark]
+    if len(chunk):
+      chunk = chunk.astype(object).where(chunk.notna(), None)
+      active = chunk["active"].astype(int) == 1
+      yield chunk[active], chunk[~active]
 
-  description = pd.read_csv(description, sep='\t', dtype=str)
-  description.to_csv("description.csv", index=False)
+
+def delta_ingest(driver, nodes_path, descriptions_path, relationships_path, watermark=None, changes_path="delta_changes.json", batch_size=5000):
+  """
+  Applies only the concepts, descriptions and relationships of a new release whose effectiveTime is past
+  the graph's watermark. Inactive concepts are retired from the Nodes layer, inactive descriptions and
+  relationships are deleted. The ids of every touched concept are written to changes_path, with the graph
+  versions before and after the delta, so dependent artifacts (see graphConstruction/embedding_index.py --update)
+  only recompute those.
+  """
+  with driver.session() as session:
+    session.execute_write(create_indexes)
+    if watermark is None:
+      watermark = session.execute_read(graph_watermark)
+    previous_version = session.execute_read(graph_build_version)
+  if watermark is None:
+    raise ValueError("The graph has no watermark, run a full ingest or pass watermark explicitly.")
+
+  def write(query, rows):
+    for i in range(0, len(rows), batch_size):
+      with driver.session() as session:
+        session.execute_write(write_batch, query, rows.iloc[i:i + batch_size].to_dict("records"))
+
+  changed = set()
+  start = time.time()
+
+  # Concepts keep their row whether active or not, NODES_REFRESH retires the inactive ones
+  for active, inactive in changed_rows(nodes_path, watermark, batch_size * 10):
+    rows = pd.concat([active, inactive])
+    write(CONCEPT_UPSERT, rows)
+    changed.update(rows["id"])
+
+  for active, inactive in changed_rows(descriptions_path, watermark, batch_size * 10):
+    write(DESCRIPTION_UPSERT, active)
+    write(DESCRIPTION_RETIRE, inactive)
+    changed.update(active["conceptId"])
+    changed.update(inactive["conceptId"])
+
+  for active, inactive in changed_rows(relationships_path, watermark, batch_size * 10):
+    active = active.assign(relationshipType=active["relationshipGroup"].map(RELATIONSHIP_TYPES))
+    write(RELATIONSHIP_DELTA, active)
+    write(RELATIONSHIP_RETIRE, inactive)
+
+  changed = sorted(int(concept) for concept in changed)
+  for i in range(0, len(changed), batch_size):
+    with driver.session() as session:
+      session.execute_write(lambda transaction: transaction.run(NODES_REFRESH, ids=changed[i:i + batch_size]))
+
+  # New version and watermark, then the list of ids whose derived data is stale
+  version = time.strftime("%Y%m%d%H%M%S")
+  with driver.session() as session:
+    session.execute_write(record_build, version, release_watermark(nodes_path, descriptions_path, relationships_path))
+
+  with open(changes_path, "w") as file:
+    json.dump({"previous_graph_version": previous_version, "graph_version": version, "watermark": watermark, "ids": changed}, file)
+
+  print(f"Delta applied: {len(changed)} concepts changed since {watermark} in {time.time() - start:.0f}s.")
+  return changed
+
+
+# Column types of the SNOMED files, so chunks never disagree on a column's type
+SNOMED_DTYPES = {
+  "id": "int64",
+  "effectiveTime": "int64",
+  "active": "int8",
+  "moduleId": "int64",
+  "definitionStatusId": "int64",
+  "conceptId": "int64",
+  "languageCode": "string",
+  "typeId": "int64",
+  "term": "string",
+  "caseSignificanceId": "int64",
+  "sourceId": "int64",
+  "destinationId": "int64",
+  "relationshipGroup": "int64",
+  "characteristicTypeId": "int64",
+  "modifierId": "int64",
+}
+
+
+def peak_memory_mb():
+  """
+  Peak resident memory of this process so far
+  """
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def read_chunks(path, chunksize, columns=None, **options):
+  """
+  Yields DataFrames of at most chunksize rows from a CSV or a Parquet file
+  """
+  if str(path).endswith(".parquet"):
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+      yield batch.to_pandas()
+    return
+
+  yield from pd.read_csv(path, usecols=columns, chunksize=chunksize, **options)
+
+
+class TableWriter:
+  """
+  Appends DataFrame chunks to a CSV and a typed Parquet file at the same time
+  """
+
+  def __init__(self, csv_path, parquet_path):
+    self.csv_path = csv_path
+    self.parquet_path = parquet_path
+    self.writer = None
+
+  def write(self, chunk):
+    chunk.to_csv(self.csv_path, mode="a" if self.writer else "w", header=self.writer is None, index=False)
+    table = pa.Table.from_pandas(chunk, preserve_index=False)
+    if self.writer is None:
+      self.writer = pq.ParquetWriter(self.parquet_path, table.schema)
+    self.writer.write_table(table.cast(self.writer.schema))
+
+  def close(self):
+    if self.writer is not None:
+      self.writer.close()
+
+
+# Mapping the relationship number to the word
+RELATIONSHIP_TYPES = {
+  0: "ATTRIBUTE",
+  1: 'IS_A',
+  2: 'PART_OF',
+  3: 'ASSOCIATED_WITH',
+  4: 'CAUSES',
+  5: 'FOUND_AT',
+  6: "TEMPORAL"
+}
+
+
+def relation_update(input_path='CSVItems/relationship.csv', output='modified_relationship', chunksize=500000):
+  """
+  The original relationship.csv contains numerical values so modified_relationship.csv contains the actual word for which each node corresponds to.
+  The file is processed in chunks and also written as modified_relationship.parquet.
+  The SNOMED relationship id is kept so delta ingests can update and retire the Nodes-layer edges built from it.
+  """
+
+  # Only these columns are kept
+  columns = ["id", "sourceId", "destinationId", "relationshipGroup"]
+
+  writer = TableWriter(f"{output}.csv", f"{output}.parquet")
+  for chunk in pd.read_csv(input_path, usecols=columns, dtype=SNOMED_DTYPES, chunksize=chunksize):
+    # Maps and deletes columns
+    chunk["relationshipType"] = chunk["relationshipGroup"].map(RELATIONSHIP_TYPES).astype("string")
+    writer.write(chunk.drop(columns=["relationshipGroup"]))
+  writer.close()
+
+
+def fixDescription(description, output="description", chunksize=500000):
+  """
+  Description CSV has errors has the term column has commas within the term segment. Additionally, there are quotations which were removed manually. 
+  Lines are streamed, so the file is never held in memory, and the result is written as description.csv and description.parquet.
+  """
+  cleaned = f"{description}.cleaned"
+
+  # Drop the commas line by line
+  with open(description, 'r', encoding='utf-8') as infile, open(cleaned, 'w', encoding='utf-8') as outfile:
+    for line in infile:
+      outfile.write(line.replace(',', ''))
+  os.replace(cleaned, description)
+
+  writer = TableWriter(f"{output}.csv", f"{output}.parquet")
+  for chunk in pd.read_csv(description, sep='\t', dtype=SNOMED_DTYPES, quoting=csv.QUOTE_NONE, chunksize=chunksize):
+    writer.write(chunk)
+  writer.close()
 
 
 def clean_csv(input_path, output_path):
@@ -183,7 +512,7 @@ def clean_csv(input_path, output_path):
     There is also encoding issues has the data wasn't in UTF-8 format so it was rewritten.
     """
 
-    # Reopen and fix encoding issues
+    # Reopen and fix encoding issues, one row at a time
     with open(input_path, 'r', encoding='utf-8') as infile, open(output_path, 'w', encoding='utf-8', newline='') as outfile:
         reader = csv.reader(infile)
         writer = csv.writer(outfile)
@@ -194,72 +523,103 @@ def clean_csv(input_path, output_path):
         print("Clean-up complete.")
 
 
-def combine_nodes():
+def partition(path, column, columns, spill, partitions, chunksize):
   """
-  We can combine certain elements of nodes.csv and description.csv to allow for faster uploading.
+  Splits a file into partition files by column % partitions so each one fits in memory on its own
   """
+  for chunk in read_chunks(path, chunksize, columns):
+    # Unparseable ids are dropped, like the NaN conceptIds before
+    chunk[column] = pd.to_numeric(chunk[column], errors="coerce")
+    chunk = chunk.dropna(subset=[column])
+    chunk[column] = chunk[column].astype("int64")
 
-  # We join the nodes.id with the descriptions.conceptId
-  nodes = pd.read_csv("CSVItem/nodes.csv", usecols=["id", "active"], dtype={"id": "int"})
-  descriptions = pd.read_csv("CSVItem/description.csv", usecols=["conceptId", "term", "effectiveTime"])
+    for part, group in chunk.groupby(chunk[column] % partitions):
+      target = spill / f"{column}-{part}.csv"
+      group.to_csv(target, mode="a", header=not target.exists(), index=False)
 
-  # Drop all rows with NaN values
-  descriptions = descriptions.dropna(subset=["conceptId"])
-  descriptions["conceptId"] = descriptions["conceptId"].astype(int)  # convert to int
 
-  # Fill all effectiveTime to 0 if they are null then convert to integer
-  descriptions["effectiveTime"] = pd.to_numeric(descriptions["effectiveTime"], errors='coerce')
-  descriptions["effectiveTime"] = descriptions["effectiveTime"].fillna(0).astype(int)
-
-  # Merge the two
-  merged = pd.merge(nodes, descriptions, left_on="id", right_on="conceptId", how="left")
-
-  # This isn't needed, we'll delete it
-  merged.drop(columns=["conceptId"], inplace=True)
-
-  # There are multiple terms for each ID so we join them together with the semicolon
-  merged = merged.groupby(["id", "active"])["term"].apply(lambda x: ';'.join(x.astype(str))).reset_index()
-  merged = merged.rename(columns={"term": "descriptions"})
-
-  # Convert to CSV
-  merged.to_csv("CSVItem/merged_nodes.csv", index=False)
+def combine_nodes(nodes_path="CSVItem/nodes.csv", descriptions_path="CSVItem/description.csv", output="CSVItem/merged_nodes", partitions=64, chunksize=500000):
+  """
+  We can combine certain elements of nodes.csv and description.csv to allow for faster uploading.
+  Both files are hash-partitioned on the concept id into a spill directory, then every partition is joined
+  and aggregated on its own, so memory depends on the partition size rather than on the release.
+  """
+  with tempfile.TemporaryDirectory() as spill:
+    spill = Path(spill)
+    partition(nodes_path, "id", ["id", "active"], spill, partitions, chunksize)
+    partition(descriptions_path, "conceptId", ["conceptId", "term", "effectiveTime"], spill, partitions, chunksize)
+
+    writer = TableWriter(f"{output}.csv", f"{output}.parquet")
+    for part in range(partitions):
+      nodes_part = spill / f"id-{part}.csv"
+      if not nodes_part.exists():
+        continue
+      nodes = pd.read_csv(nodes_part, dtype={"id": "int64", "active": "int8"})
+
+      descriptions_part = spill / f"conceptId-{part}.csv"
+      if descriptions_part.exists():
+        descriptions = pd.read_csv(descriptions_part, dtype={"conceptId": "int64", "term": "string"})
+      else:
+        descriptions = pd.DataFrame({"conceptId": pd.Series(dtype="int64"), "term": pd.Series(dtype="string"), "effectiveTime": pd.Series(dtype="float64")})
+
+      # Fill all effectiveTime to 0 if they are null then convert to integer
+      descriptions["effectiveTime"] = pd.to_numeric(descriptions["effectiveTime"], errors='coerce').fillna(0).astype("int64")
+
+      # There are multiple terms for each ID so we join them together with the semicolon.
+      # Arrow collects and joins them in its kernels, there is no Python call per concept, and
+      # grouping without threads keeps the terms of a concept in file order
+      descriptions = descriptions.dropna(subset=["term"])
+      grouped = pa.Table.from_pandas(descriptions[["conceptId", "term", "effectiveTime"]], preserve_index=False) \
+        .group_by("conceptId", use_threads=False) \
+        .aggregate([("term", "list"), ("effectiveTime", "max")])
+      terms = pd.DataFrame(
+        {"descriptions": pc.binary_join(grouped["term_list"], ";").to_numpy(), "effectiveTime": grouped["effectiveTime_max"].to_numpy()},
+        index=grouped["conceptId"].to_numpy(),
+      )
+
+      merged = nodes.merge(terms, left_on="id", right_index=True, how="left")
+      merged["descriptions"] = merged["descriptions"].fillna("").astype("string")
+      merged["effectiveTime"] = merged["effectiveTime"].fillna(0).astype("int64")
+      writer.write(merged.sort_values("id")[["id", "active", "descriptions", "effectiveTime"]])
+    writer.close()
 
 
 def main():
   uri = "bolt://localhost:7687"
   username = os.getenv("NEO4J_USER")
-  password = os.genenv("NEO4J_PASS")
+  password = os.getenv("NEO4J_PASS")
   # username = "neo4j"
   # password = "PASSWORD"
 
   # Get information
   node, descriptio, relationship = local_requirements()
 
-  nodes = pd.read_csv(node)
-  description = pd.read_csv(descriptio)
-  relationships = pd.read_csv(relationship)
-
-  # Make CSV
-  to_csv(nodes, description, relationships)
+  # Make CSV and Parquet, in chunks
+  to_csv(node, descriptio, relationship)
+  print(f"Converted source files, peak memory {peak_memory_mb():.0f} MB.")
 
   # Connect to Neo4J
   driver = GraphDatabase.driver(uri, auth=(username, password))
 
   # Fix relationships to get modified_relationship.csv
   relation_update()
+  print(f"Relationships mapped, peak memory {peak_memory_mb():.0f} MB.")
 
   # Fix and clean descriptions
   fixDescription(descriptio)
   clean_csv(relationship, "CSVItems/modified_relationship.csv")
+  print(f"Descriptions fixed, peak memory {peak_memory_mb():.0f} MB.")
 
   # Combine description with the nodes
   combine_nodes()
+  print(f"Nodes combined, peak memory {peak_memory_mb():.0f} MB.")
+
+  # Populate the database from the typed Parquet files, one transaction per batch and resumable
+  ingest(driver, "nodes.parquet", "description.parquet", "relationship.parquet")
 
-  # Populate the database
   with driver.session() as session:
-    session.execute_write(create_indexes)
-    session.execute_write(populate_nodes, node=nodes, description=description)
-    session.execute_write(populate_relationships, relationships)
+    session.execute_write(create_fulltext_index)
+    session.execute_write(record_build, time.strftime("%Y%m%d%H%M%S"), release_watermark("nodes.parquet", "description.parquet", "relationship.parquet"))
 
 
 if __name__ == "__main__":
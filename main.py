@@ -1,23 +1,30 @@
 import streamlit as st
 import requests
 import os
-import threading
-import uvicorn
+import time
+import uuid
 from openai import OpenAI
-from api import app as fastapi_app
-from multiprocessing import Process
-
-# Load environment variables
-API_URL = "http://127.0.0.1:8000/query"
+from requests.adapters import HTTPAdapter
+from extractor import SymptomMatcher, SYMPTOM_MATCHER_PATH
+
+# The API runs as its own service (python serve.py)
+API_BASE_URL = os.getenv("API_BASE_URL", "http://127.0.0.1:8000").rstrip("/")
+API_URL = f"{API_BASE_URL}/query"
+STREAM_URL = f"{API_BASE_URL}/query/stream"
+API_POOL_SIZE = int(os.getenv("API_POOL_SIZE", "10"))  # keep-alive connections to the API
 client = OpenAI(api_key=st.secrets["openai"]["api_key"])
 
-# Function to start the FastAPI server
-def start_fastapi():
-    uvicorn.run(fastapi_app, host="127.0.0.1", port=8000, log_level="info")
+# Ask GPT for the terms only when the local matcher finds nothing
+GPT_EXTRACTION_FALLBACK = os.getenv("GPT_EXTRACTION_FALLBACK", "1") == "1"
 
-# Start FastAPI in a separate process
-fastapi_process = Process(target=start_fastapi)
-fastapi_process.start()
+# One pooled session per Streamlit server, reruns reuse its connections
+@st.cache_resource
+def api_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=API_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 # Configure Streamlit page
 st.set_page_config(page_title="MedicalRAG Chat", page_icon="💬", layout="wide")
@@ -45,6 +52,9 @@ for name in conversation_names:
     if st.sidebar.button(name):
         st.session_state.active_conversation = name
 
+# Streaming shows the answer token by token instead of after the whole completion
+stream_responses = st.sidebar.checkbox("Stream responses", value=True)
+
 # Get the current active conversation
 active_conversation = st.session_state.active_conversation
 
@@ -59,8 +69,26 @@ for role, text in st.session_state.conversations[active_conversation]:
 # Text input for user message
 user_input = st.text_input("Type in your medical query:")
 
+# Loaded once per Streamlit server, not on every rerun
+@st.cache_resource
+def load_symptom_matcher():
+    if not os.path.exists(SYMPTOM_MATCHER_PATH):
+        return None
+    return SymptomMatcher.load(SYMPTOM_MATCHER_PATH)
+
 # Function to extract symptoms
 def extract_symptoms(user_input):
+    # Local dictionary match against the graph's terms first, it takes microseconds
+    matcher = load_symptom_matcher()
+    if matcher is not None:
+        symptoms = matcher.extract(user_input)
+        if symptoms or not GPT_EXTRACTION_FALLBACK:
+            return symptoms
+
+    return extract_symptoms_gpt(user_input)
+
+# Function to extract symptoms through GPT
+def extract_symptoms_gpt(user_input):
     try:
         # prompt = (
         #     "The following user input contains a description of a health condition. "
@@ -91,8 +119,15 @@ def extract_symptoms(user_input):
 # Handle message submission
 if st.button("Send") and user_input:
     st.session_state.conversations[active_conversation].append(("user", user_input))
+    start = time.perf_counter()
     symptoms = extract_symptoms(user_input)
 
+    # The request id ties this message to the API metrics and profiles, extraction time is reported with it
+    headers = {
+        "X-Request-ID": uuid.uuid4().hex,
+        "X-Extraction-Ms": f"{(time.perf_counter() - start) * 1000:.1f}"
+    }
+
     # Make a POST request to the FastAPI backend    
     try:
         # Include both symptoms and the original user input in the payload
@@ -101,13 +136,22 @@ if st.button("Send") and user_input:
             "user_input": user_input
         }
         
-        response = requests.post(API_URL, json=payload)
-        if response.status_code == 200:
-            backend_response = response.json().get("response", "No response received.")
-            st.session_state.conversations[active_conversation].append(("MedicalRAG", backend_response))
-            st.markdown(f"**MedicalRAG:** {backend_response}")
+        if stream_responses:
+            with api_session().post(STREAM_URL, json=payload, headers=headers, stream=True) as response:
+                if response.status_code == 200:
+                    st.markdown("**MedicalRAG:**")
+                    backend_response = st.write_stream(response.iter_content(chunk_size=None, decode_unicode=True))
+                    st.session_state.conversations[active_conversation].append(("MedicalRAG", backend_response))
+                else:
+                    st.error(f"Error from backend: {response.status_code} - {response.text}")
         else:
-            st.error(f"Error from backend: {response.status_code} - {response.text}")
+            response = api_session().post(API_URL, json=payload, headers=headers)
+            if response.status_code == 200:
+                backend_response = response.json().get("response", "No response received.")
+                st.session_state.conversations[active_conversation].append(("MedicalRAG", backend_response))
+                st.markdown(f"**MedicalRAG:** {backend_response}")
+            else:
+                st.error(f"Error from backend: {response.status_code} - {response.text}")
     except Exception as e:
         st.error(f"Exception occurred while calling backend API: {e}")
 
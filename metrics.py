@@ -0,0 +1,138 @@
+from prometheus_client import Histogram, Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import Counter as StackCounter
+import threading
+import time
+import uuid
+import sys
+import os
+import re
+
+
+# Opt-in sampling profiler: requests slower than PROFILE_SLOW_MS dump their samples to PROFILE_DIR
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))  # 0 disables profiling
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# Set by serve.py when several workers write their samples to files that /metrics merges
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+# Request id of the request being handled, set by the API middleware
+request_id = ContextVar("request_id", default="-")
+
+# Caller supplied ids end up in logs, headers and file names, anything else is replaced
+REQUEST_ID = re.compile(r"[A-Za-z0-9-]{1,64}")
+
+
+def accept_request_id(value) -> str:
+    """
+    The caller's request id if it is short and plain, otherwise a fresh one
+    """
+    if value and REQUEST_ID.fullmatch(value):
+        return value
+    return uuid.uuid4().hex
+
+STAGE_LATENCY = Histogram(
+    "medicalrag_stage_seconds",
+    "Latency of each stage of the /query pipeline",
+    ["stage"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
+CANDIDATE_ROWS = Histogram(
+    "medicalrag_candidate_rows",
+    "Related node rows returned by the graph for one symptom",
+    buckets=(0, 1, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+
+REQUESTS = Counter("medicalrag_requests", "Requests handled by the API", ["endpoint", "status"])
+
+DEGRADED = Counter("medicalrag_degraded", "Answers that went through a fallback", ["path"])
+
+
+@contextmanager
+def span(stage:str):
+    """
+    Time a block of the pipeline into the stage latency histogram
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(stage).observe(time.perf_counter() - start)
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread while at least one profiled request is running and
+    writes them in folded-stack format (flamegraph.pl, speedscope) for requests over the threshold.
+    Concurrent requests share the samples taken during their lifetime.
+    """
+
+    def __init__(self, interval_ms:float=PROFILE_INTERVAL_MS, slow_ms:float=PROFILE_SLOW_MS, output:str=PROFILE_DIR):
+        self.interval = interval_ms / 1000
+        self.slow_ms = slow_ms
+        self.output = output
+        self.active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.slow_ms > 0
+
+    def _sample(self):
+        while True:
+            with self._lock:
+                if not self.active:
+                    self._thread = None
+                    return
+                recorders = list(self.active.values())
+
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == threading.get_ident():
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                folded = ";".join([names.get(ident, str(ident))] + stack[::-1])
+                for samples in recorders:
+                    samples[folded] += 1
+
+            time.sleep(self.interval)
+
+    def start(self) -> str:
+        """
+        Start recording for one request. The key is generated here, so requests sharing an id never collide
+        """
+        key = uuid.uuid4().hex
+        with self._lock:
+            self.active[key] = StackCounter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+                self._thread.start()
+        return key
+
+    def stop(self, key:str, elapsed_ms:float, label:str="-"):
+        with self._lock:
+            samples = self.active.pop(key, None)
+        if samples is None or elapsed_ms < self.slow_ms:
+            return
+
+        # A profile is best effort, failing to write it must never fail the request
+        path = os.path.join(self.output, f"{int(time.time())}-{label}-{key[:8]}.folded")
+        try:
+            os.makedirs(self.output, exist_ok=True)
+            with open(path, "w") as file:
+                for stack, count in samples.items():
+                    file.write(f"{stack} {count}\n")
+        except OSError as error:
+            print(f"Could not write the profile of request {label}: {error}")
+            return
+        print(f"Request {label} took {elapsed_ms:.0f} ms, profile written to {path}.")
+
+
+profiler = SamplingProfiler()
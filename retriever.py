@@ -1,11 +1,22 @@
-from neo4j import GraphDatabase
+from neo4j import AsyncGraphDatabase, GraphDatabase
+import asyncio
 import json
 import os
 from transformers import AutoTokenizer, AutoModel
 import torch
-import heapq
+import numpy as np
 import streamlit as st
 import ssl
+import threading
+import sqlite3
+import hashlib
+import queue
+import re
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+from metrics import span, STAGE_LATENCY, CANDIDATE_ROWS
+from extractor import SEMANTIC_TAG
 
 
 # Neo4j Credentials
@@ -17,135 +28,1078 @@ ssl_context = ssl.create_default_context()
 ssl_context.check_hostname = False
 ssl_context.verify_mode = ssl.CERT_NONE
 
-def query_db(transaction, symptom:str) -> list[list[str]]:
+# Connection pool of the app-scoped driver
+NEO4J_POOL_SIZE = int(os.getenv("NEO4J_POOL_SIZE", "50"))
+NEO4J_ACQUISITION_TIMEOUT = float(os.getenv("NEO4J_ACQUISITION_TIMEOUT", "10"))  # seconds to wait for a free connection
+NEO4J_MAX_LIFETIME = float(os.getenv("NEO4J_MAX_LIFETIME", "3600"))  # seconds before a connection is recycled
+
+# Model settings, overridable through the environment
+MODEL_NAME = os.getenv("MODEL_NAME", "medicalai/ClinicalBERT")
+MODEL_REVISION = os.getenv("MODEL_REVISION", "main")
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR")  # local directory with the downloaded weights
+MODEL_OFFLINE = os.getenv("MODEL_OFFLINE", "0") == "1"  # only read from MODEL_CACHE_DIR, never download
+MODEL_THREADS = int(os.getenv("MODEL_THREADS", "0"))  # intra-op threads, 0 keeps torch's default
+MODEL_INTEROP_THREADS = int(os.getenv("MODEL_INTEROP_THREADS", "0"))  # inter-op threads, 0 keeps torch's default
+MODEL_PRECISION = os.getenv("MODEL_PRECISION", "fp32")  # "fp32", "int8" (dynamic quantization) or "bf16"
+MODEL_TRACE = os.getenv("MODEL_TRACE", "0") == "1"  # run through TorchScript traces of fixed sequence-length buckets
+TRACE_BUCKETS = [16, 32, 64, 128, 256, 512]
+MODEL_EAGER_LOAD = os.getenv("MODEL_EAGER_LOAD", "1") == "1"
+
+# Batching limits for the encoder
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "64"))  # sequences per forward pass
+EMBED_MAX_TOKENS = int(os.getenv("EMBED_MAX_TOKENS", "8192"))  # padded tokens per forward pass
+
+# Precomputed node embeddings written by graphConstruction/embedding_index.py
+EMBED_INDEX_DIR = os.getenv("EMBED_INDEX_DIR", "embedding_index")
+
+# How a concept is scored: "max" or "mean" over its separately embedded terms, or "none" to embed the ';'-joined blob
+TERM_POOLING = os.getenv("TERM_POOLING", "max")
+
+# Inference worker: bounded job queue, merged into micro-batches
+INFER_QUEUE_SIZE = int(os.getenv("INFER_QUEUE_SIZE", "256"))  # pending encode jobs before requests are refused
+INFER_MAX_BATCH = int(os.getenv("INFER_MAX_BATCH", "256"))  # texts merged into one micro-batch
+INFER_MAX_WAIT_MS = float(os.getenv("INFER_MAX_WAIT_MS", "5"))  # how long the worker waits for more jobs to merge
+
+# Queries of a /query/batch request scored together
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "64"))
+
+# Seed lookup: "fulltext" uses the nodeDescriptions index, "contains" the original label scan
+SEED_MODE = os.getenv("SEED_MODE", "fulltext")
+SEED_LIMIT = int(os.getenv("SEED_LIMIT", "10"))  # most relevant seed nodes expanded per symptom
+
+# Neighborhood expansion around the seeds
+NEIGHBOR_LIMIT = int(os.getenv("NEIGHBOR_LIMIT", "25"))  # closest neighbors kept per seed
+CANDIDATE_LIMIT = int(os.getenv("CANDIDATE_LIMIT", "100"))  # distinct neighbors returned per symptom
+
+# Where related nodes come from: "neo4j" over Bolt, or "snapshot" for the in-process CSR export
+GRAPH_BACKEND = os.getenv("GRAPH_BACKEND", "neo4j")
+GRAPH_SNAPSHOT_DIR = os.getenv("GRAPH_SNAPSHOT_DIR", "graph_snapshot")
+
+# Ranking features on top of the cosine score
+HOP_PENALTY = float(os.getenv("HOP_PENALTY", "0"))  # subtracted once per hop beyond the first
+EDGE_WEIGHTS = json.loads(os.getenv("EDGE_WEIGHTS", "{}"))  # bonus per relationship type, e.g. {"CAUSES": 0.05}
+
+# Deadlines of the retrieval stages in seconds, 0 waits as long as it takes
+GRAPH_TIMEOUT = float(os.getenv("GRAPH_TIMEOUT", "10"))  # seed lookup and expansion of every symptom, the request fails after it
+EMBED_TIMEOUT = float(os.getenv("EMBED_TIMEOUT", "5"))  # encoding, ranking falls back to full-text relevance after it
+
+# Embedding cache for texts that are not in the index (user symptoms, newly ingested nodes)
+EMBED_CACHE_BYTES = int(os.getenv("EMBED_CACHE_BYTES", str(64 * 1024 * 1024)))  # in-memory budget
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "embedding_cache.sqlite")  # shared by every worker, empty disables it
+EMBED_CACHE_ROWS = int(os.getenv("EMBED_CACHE_ROWS", "500000"))  # on-disk budget, the oldest rows are pruned beyond it
+
+
+class BucketedTrace(torch.nn.Module):
+    """
+    Runs the model through frozen TorchScript traces, one per sequence-length bucket.
+    Batches are right-padded up to their bucket so every call hits an already traced shape.
+    """
+
+    def __init__(self, model, buckets:list=TRACE_BUCKETS):
+        super().__init__()
+        self.model = model
+        self.config = model.config
+        self.buckets = buckets
+        self.traces = {}
+
+    def forward(self, input_ids, attention_mask):
+        length = input_ids.shape[1]
+        bucket = next((size for size in self.buckets if size >= length), length)
+        if bucket > length:
+            input_ids = torch.nn.functional.pad(input_ids, (0, bucket - length), value=self.config.pad_token_id or 0)
+            attention_mask = torch.nn.functional.pad(attention_mask, (0, bucket - length), value=0)
+
+        if bucket not in self.traces:
+            with torch.no_grad():
+                traced = torch.jit.trace(self.model, (input_ids, attention_mask), strict=False)
+                self.traces[bucket] = torch.jit.freeze(traced.eval())
+
+        outputs = self.traces[bucket](input_ids, attention_mask)
+        hidden = outputs["last_hidden_state"] if isinstance(outputs, dict) else outputs[0]
+        return SimpleNamespace(last_hidden_state=hidden[:, :length])
+
+
+def bf16_supported() -> bool:
+    # bf16 matmuls are only fast on CPUs with AVX512-BF16 or AMX
+    return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+
+def prepare_model(model, precision:str=MODEL_PRECISION, trace:bool=MODEL_TRACE):
+    """
+    Put a loaded model in eval mode in the requested inference precision
+    """
+    model.eval()
+
+    if precision == "int8":
+        # Linear layers hold nearly all of BERT's weights and FLOPs
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif precision == "bf16":
+        if bf16_supported():
+            model = model.to(torch.bfloat16)
+        else:
+            print("This CPU has no bf16 support, keeping fp32.")
+
+    if trace:
+        model = BucketedTrace(model)
+    return model
+
+
+def load_model(precision:str=MODEL_PRECISION, trace:bool=MODEL_TRACE):
+    """
+    Load the tokenizer and a model prepared for inference
+    """
+    options = {"revision": MODEL_REVISION, "cache_dir": MODEL_CACHE_DIR, "local_files_only": MODEL_OFFLINE}
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, **options)
+    model = AutoModel.from_pretrained(MODEL_NAME, **options)
+    return tokenizer, prepare_model(model, precision, trace)
+
+
+class ModelRegistry:
+    """
+    Holds the tokenizer and model for the whole process so they are only loaded once.
+    """
+
+    def __init__(self):
+        self.tokenizer = None
+        self.model = None
+        self.ready = False
+        self._lock = threading.Lock()
+
+    def load(self, warmup:bool=True):
+        """
+        Load the tokenizer and model in eval mode and run a warmup forward pass.
+        serve.py loads the weights without the warmup before forking, each worker warms up on its own.
+        """
+        with self._lock:
+            if self.ready:
+                return
+
+            with span("model_load"):
+                if self.model is None:
+                    if MODEL_THREADS > 0:
+                        torch.set_num_threads(MODEL_THREADS)
+                    if MODEL_INTEROP_THREADS > 0:
+                        try:
+                            torch.set_num_interop_threads(MODEL_INTEROP_THREADS)
+                        except RuntimeError:
+                            # Only allowed before torch starts any inter-op work
+                            print("Inter-op threads were already started, MODEL_INTEROP_THREADS ignored.")
+
+                    self.tokenizer, self.model = load_model()
+
+                if not warmup:
+                    return
+
+                # The first forward pass allocates the kernels, pay it before serving.
+                # Traced models are compiled per bucket, so every bucket is warmed up
+                compute_embeddings(self.tokenizer, self.model, "warmup")
+                if MODEL_TRACE:
+                    for bucket in TRACE_BUCKETS:
+                        _forward(self.tokenizer, self.model, [[self.tokenizer.cls_token_id] * bucket])
+            self.ready = True
+
+    def get(self):
+        """
+        Return the tokenizer and model, loading them first if needed.
+        """
+        if not self.ready:
+            self.load()
+        return self.tokenizer, self.model
+
+
+registry = ModelRegistry()
+
+
+def index_granularity() -> str:
+    return "descriptions" if TERM_POOLING == "none" else "terms"
+
+def description_units(description:str) -> list[str]:
+    """
+    The texts a concept is embedded as: each distinct synonym on its own, or the whole description
+    """
+    if TERM_POOLING == "none":
+        return [description]
+    terms = dict.fromkeys(SEMANTIC_TAG.sub("", term).strip() for term in description.split(";"))
+    return [term for term in terms if term] or [description]
+
+
+class EmbeddingIndex:
+    """
+    Memory-mapped embeddings of every Nodes.descriptions, looked up by node id.
+    A node owns the rows starts[row]:ends[row] of vectors, one per unit from description_units.
+    """
+
+    def __init__(self, path:str=EMBED_INDEX_DIR):
+        self.path = path
+        self.vectors = None
+        self.ids = None
+        self.starts = None
+        self.ends = None
+        self.rows = None
+        self.meta = {}
+
+    def load(self, graph_version) -> bool:
+        """
+        Map the index into memory if it exists and was built from the current graph and model.
+        """
+        meta_path = os.path.join(self.path, "meta.json")
+        if not os.path.exists(meta_path):
+            print(f"No embedding index at {self.path}, graph descriptions will be encoded per request.")
+            return False
+
+        with open(meta_path) as file:
+            meta = json.load(file)
+
+        # A rebuilt graph, a different model or another precision makes every stored row stale
+        expected = {"graph_version": graph_version, "model": MODEL_NAME, "revision": MODEL_REVISION, "precision": MODEL_PRECISION, "granularity": index_granularity()}
+        stale = {key: meta.get(key) for key in expected if meta.get(key) != expected[key]}
+        if stale:
+            print(f"Embedding index at {self.path} is stale ({stale} != {expected}), ignoring it.")
+            return False
+
+        self.vectors = np.load(os.path.join(self.path, "vectors.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(self.path, "ids.npy"))
+        self.starts = np.load(os.path.join(self.path, "starts.npy"), mmap_mode="r")
+        self.ends = np.load(os.path.join(self.path, "ends.npy"), mmap_mode="r")
+        self.rows = {int(node_id): row for row, node_id in enumerate(self.ids)}
+        self.meta = meta
+        return True
+
+    @property
+    def loaded(self) -> bool:
+        return self.vectors is not None
+
+    def contains(self, node_id) -> bool:
+        return self.loaded and node_id is not None and int(node_id) in self.rows
+
+    def units(self, node_id) -> np.ndarray:
+        """
+        The stored unit vectors of one node
+        """
+        row = self.rows[int(node_id)]
+        return np.asarray(self.vectors[self.starts[row]:self.ends[row]], dtype=np.float32)
+
+
+embedding_index = EmbeddingIndex()
+
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache: a byte-bounded in-memory LRU in front of a row-bounded on-disk SQLite store.
+    Keys include the model name, revision and precision so vectors from another model are never returned.
+    """
+
+    def __init__(self, max_bytes:int=EMBED_CACHE_BYTES, path:str=EMBED_CACHE_PATH, max_rows:int=EMBED_CACHE_ROWS):
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self.path = path
+        self._db = None
+        self._pid = None
+        self._inherited = []
+
+    def _connection(self):
+        """
+        This process's SQLite connection, opened on first use. A connection must never cross a fork,
+        so a worker forked by serve.py opens its own instead of using the parent's.
+        """
+        if not self.path:
+            return None
+
+        if self._pid != os.getpid():
+            if self._db is not None:
+                # Closing the parent's connection from the child would touch its locks, it is only kept referenced
+                self._inherited.append(self._db)
+
+            # WAL lets several worker processes read while one writes
+            self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+            self._db.commit()
+            self._pid = os.getpid()
+        return self._db
+
+    @staticmethod
+    def normalize(text:str) -> str:
+        # The tokenizer ignores runs of whitespace, case matters to a cased model like ClinicalBERT
+        return " ".join(text.split())
+
+    @classmethod
+    def key(cls, text:str) -> str:
+        return hashlib.sha1(f"{MODEL_NAME}@{MODEL_REVISION}/{MODEL_PRECISION}:{cls.normalize(text)}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key:str, vector:np.ndarray):
+        """
+        Put a vector in the LRU and evict the least recently used ones until it fits the budget
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+
+        self.entries[key] = vector
+        self.size += vector.nbytes
+        while self.size > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes
+            self.evictions += 1
+
+    def get(self, text:str):
+        key = self.key(text)
+        with self._lock:
+            vector = self.entries.get(key)
+            if vector is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return vector
+
+            db = self._connection()
+            if db is not None:
+                row = db.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    # frombuffer is a read-only view of the row's bytes, the cache hands out its own copy
+                    vector = np.frombuffer(row[0], dtype=np.float32).copy()
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+                    return vector
+
+            self.misses += 1
+            return None
+
+    def put_many(self, texts:list[str], vectors:torch.tensor):
+        values = vectors.numpy().astype(np.float32)
+        keys = [self.key(text) for text in texts]
+        with self._lock:
+            for key, vector in zip(keys, values):
+                self._remember(key, vector)
+
+            db = self._connection()
+            if db is not None:
+                db.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", [(key, vector.tobytes()) for key, vector in zip(keys, values)])
+                # A written row gets the next rowid, so everything below the newest max_rows is the oldest and goes
+                db.execute("DELETE FROM embeddings WHERE rowid <= (SELECT max(rowid) FROM embeddings) - ?", (self.max_rows,))
+                db.commit()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self.entries), "bytes": self.size}
+
+
+embedding_cache = EmbeddingCache()
+
+
+def cached_encode(tokenizer, model, items:list[str]) -> torch.tensor:
+    """
+    Like encode_batch, but only the texts missing from the cache are run through the model.
+    Texts are encoded as given, exactly like the index build, only the cache key is normalized.
+    """
+    embeddings = torch.empty(len(items), model.config.hidden_size)
+
+    # Positions of every distinct text, so repeated texts are looked up and encoded once
+    positions = {}
+    for position, item in enumerate(items):
+        positions.setdefault(EmbeddingCache.normalize(item), []).append(position)
+
+    missing = []
+    for text, where in positions.items():
+        vector = embedding_cache.get(text)
+        if vector is None:
+            missing.append(text)
+        else:
+            embeddings[where] = torch.from_numpy(vector)
+
+    if missing:
+        encoded = encode_batch(tokenizer, model, missing)
+        for row, text in enumerate(missing):
+            embeddings[positions[text]] = encoded[row]
+        embedding_cache.put_many(missing, encoded)
+
+    return embeddings
+
+
+GRAPH_VERSION_QUERY = "MATCH (b:GraphBuild) RETURN b.version AS version"
+
+class InferenceQueueFull(Exception):
+    """
+    Raised when the inference queue is full, retrieval then ranks without embeddings
+    """
+
+
+class InferenceExecutor:
+    """
+    Dedicated worker thread that owns the model. Coroutines submit encode jobs through a bounded queue
+    and the worker merges the jobs that arrive within a short window into one micro-batch,
+    so torch never runs on the event loop thread.
+    """
+
+    def __init__(self, max_queue:int=INFER_QUEUE_SIZE, max_batch:int=INFER_MAX_BATCH, max_wait_ms:float=INFER_MAX_WAIT_MS):
+        self.jobs = queue.Queue(maxsize=max_queue)
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.batches = 0
+        self.rejected = 0
+        self.abandoned = 0
+        self.last_batch_size = 0
+        self.last_wait_ms = 0.0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="inference", daemon=True)
+                self._thread.start()
+
+    async def encode(self, texts:list[str]) -> torch.tensor:
+        """
+        Queue texts for encoding and wait for their embeddings without blocking the event loop
+        """
+        self.start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        try:
+            self.jobs.put_nowait((list(texts), future, loop, time.monotonic()))
+        except queue.Full:
+            self.rejected += 1
+            raise InferenceQueueFull(f"{self.jobs.maxsize} inference jobs already queued")
+        return await future
+
+    def _live(self, job) -> bool:
+        # A caller that timed out or was cancelled has stopped waiting, its texts are not worth encoding
+        if job[1].done():
+            self.abandoned += 1
+            return False
+        return True
+
+    def _collect(self) -> list:
+        """
+        Block for one job, then keep taking jobs until the batch is full or the wait window closes.
+        Abandoned jobs are dropped and do not count towards the batch size.
+        """
+        batch = [job for job in [self.jobs.get()] if self._live(job)]
+        size = sum(len(job[0]) for job in batch)
+        deadline = time.monotonic() + self.max_wait
+
+        while size < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                job = self.jobs.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if self._live(job):
+                batch.append(job)
+                size += len(job[0])
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # Jobs can also be abandoned while the window was open
+            batch = [job for job in batch if self._live(job)]
+            if not batch:
+                continue
+            started = time.monotonic()
+            texts = [text for job in batch for text in job[0]]
+            for job in batch:
+                STAGE_LATENCY.labels("inference_wait").observe(started - job[3])
+
+            try:
+                tokenizer, model = registry.get()
+                with span("embedding"):
+                    embeddings = cached_encode(tokenizer, model, texts)
+            except Exception as error:
+                for _, future, loop, _ in batch:
+                    loop.call_soon_threadsafe(_resolve, future, None, error)
+                continue
+
+            # Hand every job its own slice of the merged batch
+            offset = 0
+            for job_texts, future, loop, _ in batch:
+                loop.call_soon_threadsafe(_resolve, future, embeddings[offset:offset + len(job_texts)], None)
+                offset += len(job_texts)
+
+            self.batches += 1
+            self.last_batch_size = len(texts)
+            self.last_wait_ms = (started - min(job[3] for job in batch)) * 1000
+
+    def stats(self) -> dict:
+        return {"queue_depth": self.jobs.qsize(), "queue_size": self.jobs.maxsize, "batches": self.batches, "rejected": self.rejected, "abandoned": self.abandoned, "last_batch_size": self.last_batch_size, "last_wait_ms": round(self.last_wait_ms, 2)}
+
+
+def _resolve(future, result, error):
+    # The waiting request may have been cancelled in the meantime
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+inference = InferenceExecutor()
+
+
+def term_hash(term:str) -> int:
+    """
+    Stable 64-bit hash of a normalized term, used by the snapshot's seed lookup
+    """
+    normalized = " ".join(term.split()).lower()
+    return int.from_bytes(hashlib.blake2b(normalized.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+
+# Splits like the standard analyzer of the nodeDescriptions index, so snapshot seeds match the same phrases
+TOKEN = re.compile(r"\w+")
+
+
+def tokens(text:str) -> list[str]:
+    return TOKEN.findall(text.lower())
+
+
+class GraphSnapshot:
+    """
+    Read-only concept graph exported by graphConstruction/graph_snapshot.py as compressed sparse rows.
+    Every array is memory-mapped, so worker processes share one copy through the OS page cache.
+    """
+
+    def __init__(self, path:str=GRAPH_SNAPSHOT_DIR):
+        self.path = path
+        self.meta = {}
+        self.loaded = False
+
+    def _array(self, name:str) -> np.ndarray:
+        return np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+
+    def load(self):
+        with open(os.path.join(self.path, "meta.json")) as file:
+            self.meta = json.load(file)
+
+        # offsets[row]:offsets[row + 1] slices the neighbors and edge types of a row
+        self.offsets = self._array("offsets")
+        self.neighbors = self._array("neighbors")
+        self.edge_types = self._array("edge_types")
+        self.node_ids = self._array("node_ids")
+        self.text_offsets = self._array("text_offsets")
+        self.text = self._array("text")
+
+        # Inverted index: sorted token hashes and a row that uses each token
+        self.token_hashes = self._array("token_hashes")
+        self.token_rows = self._array("token_rows")
+
+        self.type_names = self.meta["edge_types"]
+        self.loaded = True
+
+    def description(self, row:int) -> str:
+        return bytes(self.text[self.text_offsets[row]:self.text_offsets[row + 1]]).decode("utf-8")
+
+    def _postings(self, token:str) -> np.ndarray:
+        key = term_hash(token)
+        start = np.searchsorted(self.token_hashes, key, side="left")
+        end = np.searchsorted(self.token_hashes, key, side="right")
+        return self.token_rows[start:end]
+
+    def seeds(self, symptom:str, limit:int=SEED_LIMIT) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Rows of the concepts with a term containing the symptom as a phrase, like the full-text seed query,
+        and their specificity: the share of the best matching term the phrase covers, 1.0 for an exact term.
+        Best first, at most limit of them.
+        """
+        phrase = tokens(symptom)
+        if not phrase:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        # Rows using every token, intersected from the rarest token up
+        postings = sorted((self._postings(token) for token in set(phrase)), key=len)
+        rows = np.unique(postings[0])
+        for posting in postings[1:]:
+            rows = np.intersect1d(rows, posting)
+
+        # The inverted index has no positions, the phrase itself is checked on each candidate's terms
+        width = len(phrase)
+        found, scores = [], []
+        for row in rows.tolist():
+            best = 0.0
+            for term in self.description(row).split(";"):
+                words = tokens(term)
+                if any(words[i:i + width] == phrase for i in range(len(words) - width + 1)):
+                    best = max(best, width / len(words))
+            if best:
+                found.append(row)
+                scores.append(best)
+
+        found, scores = np.array(found, dtype=np.int64), np.array(scores, dtype=np.float32)
+        order = np.argsort(-scores, kind="stable")[:limit]
+        return found[order], scores[order]
+
+    def _edges(self, rows:np.ndarray, allowed:np.ndarray):
+        """
+        Neighbors and edge types of rows, restricted to the allowed type codes,
+        plus the position in rows each edge starts from
+        """
+        counts = np.array([self.offsets[row + 1] - self.offsets[row] for row in rows], dtype=np.int64)
+        if counts.sum() == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        neighbors = np.concatenate([self.neighbors[self.offsets[row]:self.offsets[row + 1]] for row in rows])
+        types = np.concatenate([self.edge_types[self.offsets[row]:self.offsets[row + 1]] for row in rows])
+        owners = np.repeat(np.arange(len(rows)), counts)
+        if allowed is not None:
+            keep = np.isin(types, allowed)
+            neighbors, types, owners = neighbors[keep], types[keep], owners[keep]
+        return neighbors, types, owners
+
+    def expand(self, symptom:str, relationship_types:list=None, fanout:int=NEIGHBOR_LIMIT, limit:int=CANDIDATE_LIMIT) -> list[dict]:
+        """
+        The rows query_db returns with full-text seeds: distinct neighbors up to two hops from each seed,
+        closest first, with the type of the first edge of the path and the best SeedScore that reached them.
+        Seed scores are the specificity of seeds(), not Lucene scores, so only their order carries over.
+        """
+        allowed = None
+        if relationship_types:
+            allowed = np.array([code for code, name in enumerate(self.type_names) if name in relationship_types])
+
+        found = {}
+        seeds, scores = self.seeds(symptom)
+        for seed, score in zip(seeds.tolist(), scores.tolist()):
+            # One hop, first edge to every neighbor
+            hop1, types1, _ = self._edges([seed], allowed)
+            hop1, first = np.unique(hop1, return_index=True)
+            types1 = types1[first]
+            keep = hop1 != seed
+            hop1, types1 = hop1[keep][:fanout], types1[keep][:fanout]
+            picked = [(row, 1, code) for row, code in zip(hop1.tolist(), types1.tolist())]
+
+            # Two hops only while the seed still has room, each inherits the edge that left the seed
+            if len(picked) < fanout and len(hop1):
+                hop2, _, owners = self._edges(hop1, allowed)
+                hop2, first = np.unique(hop2, return_index=True)
+                via = types1[owners[first]]
+                keep = ~np.isin(hop2, hop1) & (hop2 != seed)
+                picked += [(row, 2, code) for row, code in zip(hop2[keep][:fanout - len(picked)].tolist(), via[keep].tolist())]
+
+            # A neighbor reached from several seeds keeps its shortest distance, seeds come best first
+            # so ties keep the best seed's edge and the first score is the highest
+            for row, hops, code in picked:
+                if row not in found:
+                    found[row] = (hops, code, score)
+                elif found[row][0] > hops:
+                    found[row] = (hops, code, found[row][2])
+
+        ordered = sorted(found.items(), key=lambda item: (item[1][0], -item[1][2]))[:limit]
+        return [
+            {
+                "RelatedNodeId": int(self.node_ids[row]),
+                "RelatedNodeDescription": self.description(row),
+                "Hops": hops,
+                "RelationshipType": self.type_names[code],
+                "SeedScore": score,
+            }
+            for row, (hops, code, score) in ordered
+        ]
+
+
+graph_snapshot = GraphSnapshot()
+
+
+def graph_version(transaction):
     """
-    Send the query to the database
+    Version stamped on the graph by graphConstruction/medical_rag.py
     """
-    # Get every node that contains the word we're looking for or is one layer away from the node that contains we're looking for
-    result = transaction.run("""
+    record = transaction.run(GRAPH_VERSION_QUERY).single()
+    return record["version"] if record else None
+
+
+async def load_embedding_index(driver):
+    """
+    Load the embedding index after checking it against the graph build it was computed from.
+    """
+    async with driver.session() as session:
+        record = await (await session.run(GRAPH_VERSION_QUERY)).single()
+
+    return embedding_index.load(record["version"] if record else None)
+
+
+async def open_graph():
+    """
+    Open the configured graph backend and load the embedding index that matches it
+    """
+    if GRAPH_BACKEND == "snapshot":
+        if not graph_snapshot.loaded:
+            graph_snapshot.load()
+        return embedding_index.loaded or embedding_index.load(graph_snapshot.meta.get("graph_version"))
+
+    # One pooled driver for the whole app
+    driver = await get_driver()
+
+    # Already loaded when serve.py preloaded it before forking
+    if embedding_index.loaded:
+        return True
+
+    # Detects an index built against an older graph and falls back to encoding per request
+    return await load_embedding_index(driver)
+
+
+def preload():
+    """
+    Load what forked workers can share copy-on-write: the model weights, the graph snapshot and the
+    embedding index. Drivers, threads and the warmup pass do not survive a fork and are left to each worker.
+    """
+    registry.load(warmup=False)
+
+    if GRAPH_BACKEND == "snapshot":
+        graph_snapshot.load()
+        version = graph_snapshot.meta.get("graph_version")
+    else:
+        # A short-lived sync driver, the async one is opened by each worker on its own event loop
+        with GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD), ssl_context=ssl_context) as driver:
+            with driver.session() as session:
+                version = session.execute_read(graph_version)
+
+    return embedding_index.load(version)
+
+
+_driver = None
+
+async def get_driver():
+    """
+    The app-scoped async driver, created on first use and shared by every request.
+    """
+    global _driver
+    if _driver is None:
+        _driver = AsyncGraphDatabase.driver(
+            NEO4J_URI,
+            auth=(NEO4J_USER, NEO4J_PASSWORD),
+            ssl_context=ssl_context,
+            max_connection_pool_size=NEO4J_POOL_SIZE,
+            connection_acquisition_timeout=NEO4J_ACQUISITION_TIMEOUT,
+            max_connection_lifetime=NEO4J_MAX_LIFETIME,
+        )
+        await _driver.verify_connectivity()
+    return _driver
+
+async def close_driver():
+    global _driver
+    if _driver is not None:
+        await _driver.close()
+        _driver = None
+
+def fulltext_query(symptom:str) -> str:
+    """
+    Turn a symptom into a Lucene phrase query, escaping the characters Lucene treats as syntax
+    """
+    escaped = "".join("\\" + char if char in '\\+-!():^[]"{}~*?|&/' else char for char in symptom.lower())
+    return f'"{escaped}"'
+
+# Seed clauses, each yields the seed node n and its relevance score
+SEED_QUERIES = {
+    # Get every node that contains the word we're looking for
+    "contains": """
         MATCH (n:Nodes)
         WHERE toLower(n.descriptions) CONTAINS $symptom
-        OPTIONAL MATCH (n)-[r*1..2]-(m:Nodes)
-        RETURN DISTINCT n.descriptions AS NodeDescription, m.descriptions AS RelatedNodeDescription, r AS relationship
-        LIMIT 100
-    """, symptom=symptom.lower())
+        WITH n, 1.0 AS score
+    """,
+    # Take the best ranked seeds from the full-text index
+    "fulltext": """
+        CALL db.index.fulltext.queryNodes('nodeDescriptions', $query) YIELD node AS n, score
+        WITH n, score
+        ORDER BY score DESC
+        LIMIT $seeds
+    """,
+}
 
-    return [record for record in result]
+# Distinct neighbors up to two hops from each seed with their shortest hop distance and the
+# type of the first edge on that path. Paths are aggregated per neighbor inside the subquery so
+# hub concepts don't multiply rows, and each seed contributes at most $fanout neighbors.
+EXPANSION_QUERY = """
+    CALL {
+        WITH n
+        MATCH path = (n)-[rels*1..2]-(m:Nodes)
+        WHERE m <> n AND ($types IS NULL OR all(r IN rels WHERE coalesce(r.relationshipType, type(r)) IN $types))
+        WITH m, length(path) AS hops, coalesce(rels[0].relationshipType, type(rels[0])) AS edge
+        ORDER BY hops
+        WITH m, min(hops) AS hops, collect(edge)[0] AS edge
+        ORDER BY hops
+        LIMIT $fanout
+        RETURN m, hops, edge
+    }
+    WITH m, hops, edge, score
+    ORDER BY hops, score DESC
+    WITH m, min(hops) AS hops, collect(edge)[0] AS edge, max(score) AS score
+    RETURN m.id AS RelatedNodeId, m.descriptions AS RelatedNodeDescription, hops AS Hops, edge AS RelationshipType, score AS SeedScore
+    ORDER BY Hops, SeedScore DESC
+    LIMIT $limit
+"""
+
+async def query_db(transaction, symptom:str, relationship_types:list=None, mode:str=SEED_MODE, seeds:int=SEED_LIMIT) -> list[list[str]]:
+    """
+    Send the query to the database. relationship_types restricts the expansion to these edge types (IS_A, CAUSES, ...).
+    """
+    result = await transaction.run(
+        SEED_QUERIES[mode] + EXPANSION_QUERY,
+        symptom=symptom.lower(),
+        query=fulltext_query(symptom),
+        seeds=seeds,
+        types=relationship_types or None,
+        fanout=NEIGHBOR_LIMIT,
+        limit=CANDIDATE_LIMIT,
+    )
+
+    return [record async for record in result]
 
 def compute_embeddings(tokenizer, model, item:str) -> torch.tensor:
     """
     Get the embeddings of any string through the ClinicalBERT model
     """
-    # Initial encoding
-    raw_input = torch.tensor(tokenizer.encode(item, truncation="longest_first", max_length=512)).unsqueeze(0)
+    return encode_batch(tokenizer, model, [item])
+
+def _forward(tokenizer, model, input_ids:list[list[int]]) -> torch.tensor:
+    """
+    Pad one batch to its own longest sequence and return the CLS embeddings
+    """
+    padded = tokenizer.pad({"input_ids": input_ids}, return_tensors="pt")
 
     # Turn off gradient updating
     with torch.no_grad():
-        outputs = model(raw_input)
+        outputs = model(input_ids=padded["input_ids"], attention_mask=padded["attention_mask"])
 
-    # Return only embeddings
-    return outputs.last_hidden_state[:, 0, :]
+    # Return only embeddings, in fp32 whatever precision the model runs in
+    return outputs.last_hidden_state[:, 0, :].float()
 
-@st.cache_data
-def query_knowledge_graph(symptoms:list):
+def encode_batch(tokenizer, model, items:list[str], max_batch:int=EMBED_MAX_BATCH, max_tokens:int=EMBED_MAX_TOKENS) -> torch.tensor:
     """
-    Main handler for sending queries and recieving results.
+    Get the embeddings of many strings at once, returned as an (N, hidden) tensor in input order.
+    Inputs are sorted by token length so every batch holds sequences of similar length and wastes little padding.
+    """
+    embeddings = torch.empty(len(items), model.config.hidden_size)
+    if not items:
+        return embeddings
+
+    # Tokenize everything once, then bucket by length
+    encoded = tokenizer(list(items), truncation="longest_first", max_length=512)["input_ids"]
+    order = sorted(range(len(items)), key=lambda i: len(encoded[i]))
+
+    batch = []
+    longest = 0
+    for index in order:
+        length = len(encoded[index])
+
+        # Close the batch when it is full or when padding it to this length would go over the token budget
+        if batch and (len(batch) >= max_batch or max(longest, length) * (len(batch) + 1) > max_tokens):
+            embeddings[batch] = _forward(tokenizer, model, [encoded[i] for i in batch])
+            batch = []
+            longest = 0
+
+        batch.append(index)
+        longest = max(longest, length)
+
+    if batch:
+        embeddings[batch] = _forward(tokenizer, model, [encoded[i] for i in batch])
+
+    return embeddings
+
+def cosine_scores(queries:torch.tensor, candidates:torch.tensor) -> torch.tensor:
+    """
+    Cosine similarity of every query against every candidate as one (Q, C) matrix product
+    """
+    queries = torch.nn.functional.normalize(queries, dim=-1)
+    candidates = torch.nn.functional.normalize(candidates, dim=-1)
+    return queries @ candidates.T
+
+class GraphTimeout(Exception):
+    """
+    Raised when the graph lookups miss GRAPH_TIMEOUT, the API turns it into a 504
+    """
+
+
+def stage_timeout(seconds:float):
+    # asyncio.wait_for takes None as no deadline
+    return seconds if seconds > 0 else None
+
+
+graph_slots = asyncio.Semaphore(NEO4J_POOL_SIZE)
+
+async def fetch_related(driver, symptom:str, relationship_types:list=None) -> list:
+    """
+    Run the seed lookup and expansion of one symptom in its own session, or on the snapshot
+    """
+    if driver is None:
+        with span("graph"):
+            return graph_snapshot.expand(symptom, relationship_types)
+
+    # Large batches would otherwise queue more sessions than the pool can hand out in time
+    async with graph_slots:
+        with span("graph"):
+            async with driver.session() as session:
+                return await session.execute_read(query_db, symptom, relationship_types)
+
+def graph_features(hops:int, edge:str) -> float:
+    """
+    Score adjustment of a candidate from how it was reached in the graph
     """
+    return EDGE_WEIGHTS.get(edge, 0.0) - HOP_PENALTY * (hops - 1)
 
-    # Models
-    tk = AutoTokenizer.from_pretrained("medicalai/ClinicalBERT")
-    ml = AutoModel.from_pretrained("medicalai/ClinicalBERT")
-    cos_diff = torch.nn.CosineSimilarity()
+def pool_scores(unit_scores:torch.tensor, owners:torch.tensor, count:int, pooling:str=TERM_POOLING) -> torch.tensor:
+    """
+    Reduce (symptoms, units) scores to (symptoms, candidates), owners[u] being the candidate of unit u
+    """
+    index = owners.unsqueeze(0).expand(unit_scores.shape[0], -1)
+    pooled = torch.full((unit_scores.shape[0], count), float("-inf"))
+    return pooled.scatter_reduce(1, index, unit_scores, reduce="mean" if pooling == "mean" else "amax", include_self=False)
+
+def rank_candidates(scores:torch.tensor, membership:torch.tensor, per_symptom:int, per_result:int) -> list[tuple[float, int]]:
+    """
+    Pick the top per_symptom candidates of every symptom, then the global top per_result distinct candidates.
+    scores and membership are (symptoms, candidates); membership marks the candidates each symptom actually reached.
+    Returns (score, candidate index) pairs, best first.
+    """
+    if scores.numel() == 0:
+        return []
+
+    # Per-symptom top-k in one call, candidates a symptom did not reach can never be picked
+    masked = scores.masked_fill(~membership, float("-inf"))
+    values, indices = masked.topk(min(per_symptom, masked.shape[1]), dim=1)
+
+    # A candidate picked by several symptoms keeps its best score, which dedups by description
+    values, indices = values.flatten(), indices.flatten()
+    keep = torch.isfinite(values)
+    best = torch.full((scores.shape[1],), float("-inf")).scatter_reduce(0, indices[keep], values[keep], reduce="amax")
+
+    values, indices = best.topk(min(per_result, int(torch.isfinite(best).sum())))
+    return list(zip(values.tolist(), indices.tolist()))
+
+async def score_symptoms(unique_symptoms:list, relationship_types:list=None) -> tuple[list, torch.tensor, torch.tensor, list]:
+    """
+    Fetch and score the related nodes of distinct symptoms. Returns the candidate descriptions and the
+    (symptoms, candidates) scores and membership that rank_candidates takes, rows following unique_symptoms,
+    and the degraded paths taken, e.g. ["embedding_timeout"] when the scores are full-text relevance instead.
+    """
+
+    # Related node descriptions found for each symptom with their graph feature and seed relevance, and the id of every candidate node
+    related = {}
+    relevance = {}
+    candidates = {}
+
+    # All symptoms are fetched concurrently over the shared connection pool, the snapshot needs no driver
+    driver = None if GRAPH_BACKEND == "snapshot" else await get_driver()
+    try:
+        fetched = await asyncio.wait_for(
+            asyncio.gather(*(fetch_related(driver, symptom, relationship_types) for symptom in unique_symptoms)),
+            stage_timeout(GRAPH_TIMEOUT),
+        )
+    except asyncio.TimeoutError:
+        raise GraphTimeout(f"Graph lookups took longer than {GRAPH_TIMEOUT} s")
+
+    for symptom, results in zip(unique_symptoms, fetched):
+        CANDIDATE_ROWS.observe(len(results))
+        related[symptom] = {}
+        relevance[symptom] = {}
+        for row in results:
+            description = row["RelatedNodeDescription"]
+            if not isinstance(description, str):
+                continue
+            feature = graph_features(row["Hops"], row["RelationshipType"])
+            related[symptom][description] = max(feature, related[symptom].get(description, float("-inf")))
+            relevance[symptom][description] = max(row["SeedScore"] or 0.0, relevance[symptom].get(description, 0.0))
+            candidates.setdefault(description, row["RelatedNodeId"])
+
+    # Each candidate is scored through its units, its separate terms or its whole description.
+    # Graph-side vectors come from the precomputed index, only unknown nodes go through the model
+    texts = list(candidates)
+    rows = {text: i for i, text in enumerate(texts)}
+    node_ids = [candidates[text] for text in texts]
 
-    # Constants
-    PER_SYMPTOM = 3
-    PER_RESULT = 5
-    
-    global_best = []
-    unique_diseases = {}
+    owners = []
+    stored = []
+    pending = {}
+    for candidate, text in enumerate(texts):
+        if embedding_index.contains(node_ids[candidate]):
+            block = embedding_index.units(node_ids[candidate])
+            stored.append((len(owners), block))
+            owners.extend([candidate] * len(block))
+        else:
+            for unit in description_units(text):
+                pending.setdefault(unit, []).append(len(owners))
+                owners.append(candidate)
+
+    # Which candidates each symptom reached in the graph
+    pairs = [(position, rows[text]) for position, symptom in enumerate(unique_symptoms) for text in related[symptom]]
+    where = tuple(torch.tensor(pairs).T) if pairs else None
+
+    # Symptoms and unindexed units go to the inference worker as one job
+    pending_texts = list(pending)
+    degraded = []
+    try:
+        encoded = await asyncio.wait_for(inference.encode(unique_symptoms + pending_texts), stage_timeout(EMBED_TIMEOUT))
+    except (asyncio.TimeoutError, InferenceQueueFull) as error:
+        degraded.append("embedding_busy" if isinstance(error, InferenceQueueFull) else "embedding_timeout")
+
+    if degraded:
+        # Without embeddings, candidates keep the full-text relevance of the seed that reached them
+        scores = torch.zeros((len(unique_symptoms), len(texts)))
+        if pairs:
+            scores[where] = torch.tensor([score for symptom in unique_symptoms for score in relevance[symptom].values()])
+    else:
+        symptom_en = encoded[:len(unique_symptoms)]
+        unit_en = torch.zeros(len(owners), encoded.shape[1])
+        for start, block in stored:
+            unit_en[start:start + len(block)] = torch.from_numpy(block)
+        for row, text in enumerate(pending_texts):
+            unit_en[pending[text]] = encoded[len(unique_symptoms) + row]
+
+        # Every symptom against every unit in one matrix product, pooled into one score per candidate
+        with span("scoring"):
+            scores = pool_scores(cosine_scores(symptom_en, unit_en), torch.tensor(owners, dtype=torch.long), len(texts))
+
+    # Membership and the hop/edge adjustment of each reached candidate
+    membership = torch.zeros(scores.shape, dtype=torch.bool)
+    if pairs:
+        membership[where] = True
+        scores[where] += torch.tensor([feature for symptom in unique_symptoms for feature in related[symptom].values()])
+
+    return texts, scores, membership, degraded
+
+async def query_knowledge_graph(symptoms:list, per_symptom:int=3, per_result:int=5, relationship_types:list=None, degraded:list=None):
+    """
+    Main handler for sending queries and recieving results.
+    per_symptom candidates are kept for each symptom and per_result distinct ones are returned overall.
+    relationship_types limits the graph expansion to these edge types.
+    degraded, when given, is extended with the fallbacks the retrieval had to take.
+    """
 
     # If symptoms is empty then exit and return 1 as a error code
     if not symptoms:
         return 1
 
-    # Connect with Neo4j
-    with GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD), ssl_context=ssl_context) as driver:
-        driver.verify_connectivity()
-
-        # for each symptom provided by the user
-        for symptom in symptoms:
-
-            # Encoded the symptom provided by the user
-            symptom_en = compute_embeddings(tk, ml, symptom)
+    texts, scores, membership, fallbacks = await score_symptoms(list(dict.fromkeys(symptoms)), relationship_types)
+    if degraded is not None:
+        degraded.extend(fallbacks)
+    with span("ranking"):
+        ranked = rank_candidates(scores, membership, per_symptom, per_result)
+    return [texts[index] for _, index in ranked]
 
-            # Connect to the driver
-            with driver.session() as session:
-                results = session.execute_read(query_db, symptom)
-
-            # Top-k elements per each symptom
-            local_best = []
-
-            # Turn it into a heap
-            heapq.heapify(local_best)
-            
-            # Go through each row we get back and encode it
-            for row in results:
-                relatedNode = row["RelatedNodeDescription"]
-                
-                if not isinstance(relatedNode, str):
-                    continue
-
-                # Get embeddings of the related nodes to the node we found
-                related_en = compute_embeddings(tk, ml, relatedNode)
-
-                # Compute score with query and related nodes
-                score = cos_diff(symptom_en, related_en)
-
-                # If the list is not full then add it regardless
-                if len(local_best) <= PER_SYMPTOM:
-                    # Simply push it
-                    heapq.heappush(local_best, (score, relatedNode))
-
-                    # Make sure it is properly sorted
-                    heapq.heapify(local_best)
-
-                else:
-                    # If it is lower than the lowest value then we change
-                    if score > local_best[0][0]:
-                        # Replace it with the lowest element
-                        heapq.heapreplace(local_best, (score, relatedNode))
-
-                        heapq.heapify(local_best)
-            
-            # Sort local best in a descending fashion
-            local_reverse_best = sorted(local_best, key=lambda x: x[0], reverse=True)
-
-            # Add it to global best
-            global_best.extend(local_reverse_best)
-
-            for score, disease in local_reverse_best:
-                # if disease already there then skip to next best scored disease
-                if disease in unique_diseases:
-                    continue
-                # if disease not in unique_disease then add it
-                elif disease not in unique_diseases and len(unique_diseases) < PER_RESULT:
-                    unique_diseases[disease] = (score, disease)
-                else:
-                    # Find the disease with the lowest score
-                    lowest_score_disease = min(unique_diseases, key=lambda x: unique_diseases[x][0])
-
-                    # remove that disease
-                    del unique_diseases[lowest_score_disease]
-                    
-                    # Add new disease
-                    unique_diseases[disease] = (score, disease)
-
-    # Sort global_best and return required values
-    global_best = sorted(unique_diseases.values(), key=lambda x: x[0], reverse=True)[:PER_RESULT]
-    
-    important_results = []
-    for tenor, word in  global_best:
-        important_results.append(word) 
-
-    return important_results
+async def query_knowledge_graph_batch(queries:list, per_symptom:int=3, per_result:int=5, relationship_types:list=None, chunk_size:int=BATCH_CHUNK_SIZE):
+    """
+    Answer many symptom lists at once, yielding (position, results, degraded) as each one is ranked.
+    Queries are taken chunk_size at a time: the symptoms of a chunk are deduplicated, looked up in
+    parallel and encoded in one inference job, so memory stays flat however long the batch is.
+    """
+    for start in range(0, len(queries), chunk_size):
+        chunk = queries[start:start + chunk_size]
+        unique_symptoms = list(dict.fromkeys(symptom for symptoms in chunk for symptom in symptoms))
+        degraded = []
+        if unique_symptoms:
+            texts, scores, membership, degraded = await score_symptoms(unique_symptoms, relationship_types)
+        positions = {symptom: row for row, symptom in enumerate(unique_symptoms)}
 
+        # Each query ranks over its own rows of the shared score matrix
+        for offset, symptoms in enumerate(chunk):
+            rows = list(dict.fromkeys(positions[symptom] for symptom in symptoms))
+            with span("ranking"):
+                ranked = rank_candidates(scores[rows], membership[rows], per_symptom, per_result) if rows else []
+            yield start + offset, [texts[index] for _, index in ranked], degraded
@@ -1,9 +1,24 @@
 import streamlit as st
-from openai import OpenAI
+from openai import AsyncOpenAI
+from metrics import span, request_id, STAGE_LATENCY
+import httpx
+import time
+import os
 
-client = OpenAI(api_key=st.secrets["openai"]["api_key"])
+# OPENAI_BASE_URL lets a local OpenAI-compatible server stand in for the real API
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))  # seconds to the whole answer, or the first streamed token, 0 waits as long as it takes
 
-def generate_response(user_input, answers):
+# One async client with a shared connection pool for every request
+client = AsyncOpenAI(
+    api_key=st.secrets["openai"]["api_key"],
+    base_url=OPENAI_BASE_URL,
+    http_client=httpx.AsyncClient(limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_CONNECTIONS)),
+)
+
+def build_prompt(user_input, answers):
     # Combine the answers from the knowledge graph into a single string
     answers_str = "; ".join(answers)
 
@@ -26,10 +41,43 @@ def generate_response(user_input, answers):
         "Final Advice: [Encourage the user to seek professional help if symptoms persist]"
     )
 
-    # Make the API call
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}]
+    return prompt
+
+def fallback_response(answers):
+    # Sent instead of the generated answer when the LLM is too slow or unavailable
+    findings = "\n".join(f"- {answer}" for answer in answers)
+    return (
+        "A detailed answer could not be generated in time. These related findings were retrieved from the knowledge graph:\n"
+        f"{findings}\n\n"
+        "Please consult a healthcare professional if your symptoms persist."
+    )
+
+async def generate_response(user_input, answers):
+    # Make the API call, the request id follows it to the OpenAI-compatible server
+    with span("llm"):
+        response = await client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[{"role": "user", "content": build_prompt(user_input, answers)}],
+            extra_headers={"X-Request-ID": request_id.get()}
+        )
+
+    return response.choices[0].message.content.strip()
+
+async def stream_response(user_input, answers):
+    # Same call, but forward each token as soon as it arrives
+    start = time.perf_counter()
+    stream = await client.chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=[{"role": "user", "content": build_prompt(user_input, answers)}],
+        extra_headers={"X-Request-ID": request_id.get()},
+        stream=True
     )
 
-    return response.choices[0].message.content.strip()
\ No newline at end of file
+    first = True
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            if first:
+                STAGE_LATENCY.labels("llm_first_token").observe(time.perf_counter() - start)
+                first = False
+            yield chunk.choices[0].delta.content
+    STAGE_LATENCY.labels("llm").observe(time.perf_counter() - start)
\ No newline at end of file
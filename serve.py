@@ -0,0 +1,120 @@
+"""
+Run the API as a standalone multi-worker service.
+
+The parent process loads the model weights, the graph snapshot and the embedding index once and then
+forks the workers, which share those pages copy-on-write instead of each holding their own copy.
+Every worker accepts connections on the same listening socket, and a worker that dies is replaced.
+
+    API_WORKERS=4 API_PORT=8000 python serve.py
+"""
+import os
+import gc
+import sys
+import time
+import signal
+import socket
+import tempfile
+import traceback
+
+API_HOST = os.getenv("API_HOST", "127.0.0.1")
+API_PORT = int(os.getenv("API_PORT", "8000"))
+API_WORKERS = int(os.getenv("API_WORKERS", "2"))
+API_LOG_LEVEL = os.getenv("API_LOG_LEVEL", "info")
+
+# Read when retriever and prometheus_client are imported, so they are set before the imports below.
+# Each worker gets its share of the cores for torch unless MODEL_THREADS says otherwise
+os.environ.setdefault("MODEL_THREADS", str(max(1, (os.cpu_count() or 1) // API_WORKERS)))
+
+# Metrics of every worker are written to files that /metrics merges
+if API_WORKERS > 1:
+    os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="medicalrag-metrics-"))
+
+from prometheus_client import multiprocess
+from retriever import preload
+from api import app
+import uvicorn
+
+
+def clear_metrics(path:str):
+    # Samples left by an earlier run would be added to this one's
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        if name.endswith(".db"):
+            os.remove(os.path.join(path, name))
+
+
+def run_worker(sock:socket.socket):
+    # uvicorn installs its own handlers for a graceful shutdown
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    server = uvicorn.Server(uvicorn.Config(app, log_level=API_LOG_LEVEL))
+    server.run(sockets=[sock])
+
+
+def spawn(sock:socket.socket) -> int:
+    pid = os.fork()
+    if pid == 0:
+        # The child must never return into the parent's supervision loop
+        try:
+            run_worker(sock)
+            os._exit(0)
+        except BaseException:
+            traceback.print_exc()
+            os._exit(1)
+    return pid
+
+
+def main():
+    if API_WORKERS <= 1 or not hasattr(os, "fork"):
+        uvicorn.run(app, host=API_HOST, port=API_PORT, log_level=API_LOG_LEVEL)
+        return
+
+    clear_metrics(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+    start = time.perf_counter()
+    preload()
+    print(f"Model, graph and embedding index loaded in {time.perf_counter() - start:.1f} s.")
+
+    # Moves everything loaded so far out of the collector's reach, so it does not copy those pages
+    gc.freeze()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((API_HOST, API_PORT))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    workers = {spawn(sock) for _ in range(API_WORKERS)}
+    print(f"Serving on http://{API_HOST}:{API_PORT} with {API_WORKERS} workers.")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while workers:
+        pid, status = os.wait()
+        workers.discard(pid)
+        multiprocess.mark_process_dead(pid)
+
+        if not stopping:
+            print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, starting a new one.")
+            # Keeps a worker that fails at startup from being restarted in a tight loop
+            time.sleep(1)
+            workers.add(spawn(sock))
+
+    sock.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,16 @@
+from pathlib import Path
+import tempfile
+import sys
+import os
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT))
+sys.path.append(str(ROOT / "graphConstruction"))
+
+# retriever reads its credentials through st.secrets when imported, and streamlit looks for
+# .streamlit/secrets.toml in the working directory, so the tests run from one with dummy values
+workdir = Path(tempfile.mkdtemp(prefix="medicalrag-tests-"))
+(workdir / ".streamlit").mkdir()
+with open(workdir / ".streamlit" / "secrets.toml", "w") as file:
+    file.write('[neo4j]\nuri = "bolt://127.0.0.1:7687"\nuser = "test"\npassword = "test"\n\n[openai]\napi_key = "test"\n')
+os.chdir(workdir)
@@ -0,0 +1,118 @@
+import asyncio
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("torch")
+pytest.importorskip("neo4j")
+pytest.importorskip("streamlit")
+pytest.importorskip("transformers")
+pytest.importorskip("fastapi")
+pytest.importorskip("prometheus_client")
+pytest.importorskip("openai")
+
+from fastapi import HTTPException
+from api import ResponseCache, AdmissionControl, distinct_symptoms
+
+
+def test_distinct_symptoms_keeps_the_callers_spelling():
+    symptoms = distinct_symptoms(["Chest  Pain", "chest pain", "  ", "", "Fever"])
+    assert symptoms == {"chest pain": "Chest Pain", "fever": "Fever"}
+
+
+def test_concurrent_misses_share_one_computation():
+    cache = ResponseCache(ttl=60, max_entries=8)
+    calls = 0
+
+    async def compute():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return "answer"
+
+    async def main():
+        return await asyncio.gather(*(cache.get_or_compute("key", compute) for _ in range(5)))
+
+    assert asyncio.run(main()) == ["answer"] * 5
+    assert calls == 1
+    assert cache.stats() == {"hits": 0, "misses": 1, "shared": 4, "entries": 1, "inflight": 0}
+
+
+def test_uncacheable_results_are_not_stored():
+    cache = ResponseCache(ttl=60, max_entries=8)
+
+    async def compute():
+        return ["answer"], ["embedding_timeout"]
+
+    asyncio.run(cache.get_or_compute("key", compute, cacheable=lambda result: not result[1]))
+    assert cache.get("key") is None
+
+
+def test_entries_expire(monkeypatch):
+    cache = ResponseCache(ttl=10, max_entries=8)
+    now = 100.0
+    monkeypatch.setattr("api.time.monotonic", lambda: now)
+
+    cache.put("key", "answer")
+    now = 109.0
+    assert cache.get("key") == "answer"
+    now = 111.0
+    assert cache.get("key") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(ttl=60, max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_admission_queues_then_rejects():
+    admission = AdmissionControl(max_inflight=1, max_queued=1, wait_timeout=5)
+
+    async def main():
+        release = asyncio.Event()
+
+        async def hold():
+            async with admission.admit():
+                await release.wait()
+
+        running = asyncio.ensure_future(hold())
+        await asyncio.sleep(0)
+        queued = asyncio.ensure_future(hold())
+        await asyncio.sleep(0)
+        assert admission.stats()["running"] == 1
+        assert admission.stats()["waiting"] == 1
+
+        # The queue is full, a third request is turned away without waiting
+        with pytest.raises(HTTPException) as error:
+            async with admission.admit():
+                pass
+        assert error.value.status_code == 429
+
+        release.set()
+        await asyncio.gather(running, queued)
+
+    asyncio.run(main())
+    assert admission.stats()["rejected"] == 1
+    assert admission.stats()["running"] == 0
+
+
+def test_admission_times_out_waiting_for_a_slot():
+    admission = AdmissionControl(max_inflight=1, max_queued=4, wait_timeout=0.01)
+
+    async def main():
+        async with admission.admit():
+            with pytest.raises(HTTPException) as error:
+                async with admission.admit():
+                    pass
+            assert error.value.status_code == 503
+
+    asyncio.run(main())
+    assert admission.stats()["timed_out"] == 1
+    assert admission.stats()["waiting"] == 0
@@ -0,0 +1,68 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("torch")
+pytest.importorskip("neo4j")
+pytest.importorskip("streamlit")
+pytest.importorskip("transformers")
+
+from graph_snapshot import write_snapshot, token_hashes
+from retriever import GraphSnapshot
+
+# Two concepts share the term "fever", nothing is called "headache"
+DESCRIPTIONS = ["Fever (finding)", "Fever;Pyrexia", "Migraine (disorder)", "Infection", "Virus", "Heat", "Isolated"]
+EDGES = [(0, 3, "IS_A"), (3, 4, "DUE_TO"), (1, 5, "IS_A"), (1, 3, "FINDING_SITE")]
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    text, text_offsets, hashes, hash_rows = bytearray(), [0], [], []
+    for row, descriptions in enumerate(DESCRIPTIONS):
+        text.extend(descriptions.encode("utf-8"))
+        text_offsets.append(len(text))
+        for key in token_hashes(descriptions):
+            hashes.append(key)
+            hash_rows.append(row)
+
+    sources, destinations, types = zip(*EDGES)
+    ids = [100 + row for row in range(len(DESCRIPTIONS))]
+    write_snapshot(tmp_path, "test", ids, text_offsets, text, hashes, hash_rows, list(sources), list(destinations), list(types))
+
+    graph = GraphSnapshot(str(tmp_path))
+    graph.load()
+    return graph
+
+
+def test_seeds_match_phrases_by_specificity(snapshot):
+    # An exact term beats a term the phrase only covers half of
+    rows, scores = snapshot.seeds("Fever")
+    assert rows.tolist() == [1, 0]
+    assert scores.tolist() == [1.0, 0.5]
+
+    rows, scores = snapshot.seeds("fever  (finding)")
+    assert rows.tolist() == [0]
+    assert scores.tolist() == [1.0]
+
+    # Every token is there but not as a phrase
+    assert snapshot.seeds("finding fever")[0].tolist() == []
+    assert snapshot.seeds("pyrexia fever")[0].tolist() == []
+    assert snapshot.seeds("")[0].tolist() == []
+
+
+def test_expand_merges_every_seed(snapshot):
+    rows = snapshot.expand("fever")
+    found = {row["RelatedNodeDescription"]: (row["Hops"], row["RelationshipType"], row["SeedScore"]) for row in rows}
+
+    # "Fever;Pyrexia" is only reached from the weaker seed, a neighbor of both keeps the exact seed's edge and score
+    assert found == {
+        "Infection": (1, "FINDING_SITE", 1.0),
+        "Heat": (1, "IS_A", 1.0),
+        "Virus": (2, "FINDING_SITE", 1.0),
+        "Fever;Pyrexia": (2, "IS_A", 0.5),
+        "Fever (finding)": (2, "FINDING_SITE", 1.0),
+    }
+    assert [(row["Hops"], -row["SeedScore"]) for row in rows] == sorted((row["Hops"], -row["SeedScore"]) for row in rows)
+
+
+def test_expand_without_seed(snapshot):
+    assert snapshot.expand("headache") == []
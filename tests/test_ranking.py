@@ -0,0 +1,78 @@
+import pytest
+
+pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+pytest.importorskip("neo4j")
+pytest.importorskip("streamlit")
+pytest.importorskip("transformers")
+
+from retriever import rank_candidates, pool_scores
+
+# Two symptoms over five candidates, candidate 4 is reached by neither
+SCORES = torch.tensor([
+    [0.9375, 0.5, 0.75, 0.25, 1.0],
+    [0.25, 0.875, 0.5, 0.125, 1.0],
+])
+MEMBERSHIP = torch.tensor([
+    [True, True, True, True, False],
+    [True, True, True, False, False],
+])
+
+
+def test_keeps_per_symptom_candidates_of_each_symptom():
+    # Symptom 0 picks candidate 0, symptom 1 candidate 1
+    assert rank_candidates(SCORES, MEMBERSHIP, per_symptom=1, per_result=5) == [(0.9375, 0), (0.875, 1)]
+
+    # Symptom 0 picks 0 and 2, symptom 1 picks 1 and 2
+    ranked = rank_candidates(SCORES, MEMBERSHIP, per_symptom=2, per_result=5)
+    assert [index for _, index in ranked] == [0, 1, 2]
+
+
+def test_candidate_of_two_symptoms_is_kept_once_with_its_best_score():
+    ranked = rank_candidates(SCORES, MEMBERSHIP, per_symptom=3, per_result=5)
+    indices = [index for _, index in ranked]
+    assert len(indices) == len(set(indices))
+    assert dict((index, score) for score, index in ranked)[1] == 0.875
+    assert dict((index, score) for score, index in ranked)[0] == 0.9375
+
+
+def test_per_result_beyond_the_finite_candidates():
+    # Only four candidates were reached, asking for ten returns those four
+    ranked = rank_candidates(SCORES, MEMBERSHIP, per_symptom=5, per_result=10)
+    assert [index for _, index in ranked] == [0, 1, 2, 3]
+    assert [score for score, _ in ranked] == [0.9375, 0.875, 0.75, 0.25]
+
+
+def test_unreached_candidates_are_never_picked():
+    # Candidate 4 scores highest for both symptoms but neither reached it
+    for per_symptom in range(1, 6):
+        ranked = rank_candidates(SCORES, MEMBERSHIP, per_symptom=per_symptom, per_result=5)
+        assert 4 not in [index for _, index in ranked]
+
+    assert rank_candidates(SCORES, torch.zeros_like(MEMBERSHIP), per_symptom=3, per_result=5) == []
+
+
+def test_empty_scores():
+    assert rank_candidates(torch.empty(0, 0), torch.empty(0, 0, dtype=torch.bool), per_symptom=3, per_result=5) == []
+
+
+# Units 0-2 belong to candidate 0, unit 3 to candidate 2, candidate 1 has no unit
+UNIT_SCORES = torch.tensor([
+    [0.25, 0.75, 0.5, 0.125],
+    [1.0, 0.5, 0.0, 0.375],
+])
+OWNERS = torch.tensor([0, 0, 0, 2])
+
+
+def test_max_pooling():
+    pooled = pool_scores(UNIT_SCORES, OWNERS, 3, pooling="max")
+    assert pooled[:, 0].tolist() == [0.75, 1.0]
+    assert pooled[:, 2].tolist() == [0.125, 0.375]
+    assert torch.isinf(pooled[:, 1]).all()
+
+
+def test_mean_pooling():
+    pooled = pool_scores(UNIT_SCORES, OWNERS, 3, pooling="mean")
+    assert pooled[:, 0].tolist() == [0.5, 0.5]
+    assert pooled[:, 2].tolist() == [0.125, 0.375]
+    assert torch.isinf(pooled[:, 1]).all()